@@ -0,0 +1,155 @@
+'''
+Micro-benchmarks for hack_assembler.py
+
+python bench_assembler.py [path/to/file.asm]
+'''
+import os
+import re
+import sys
+import tempfile
+import timeit
+
+from typing import Callable, Dict, List, Tuple
+
+import hack_assembler
+
+DEFAULT_ASM = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pong', 'Pong.asm')
+REPEAT = 5
+GENERATED_LINES = 1_000_000
+
+
+def legacy_parse_a_instruct(command: str, symbols: dict):
+    command = command.strip('@')
+    if command not in symbols and not command.isdigit():
+        symbols[command] = 16 + len(symbols)
+    value = int(command) if command.isdigit() else symbols[command]
+    return f'0{value:015b}'
+
+
+def legacy_parse_c_instruct(command: str):
+    if '=' not in command:
+        dest = None
+    else:
+        dest, command = command.split('=')
+
+    if ';' not in command:
+        jump = None
+        comp = command
+    else:
+        comp, jump = command.split(';')
+
+    dest_bin = f'{hack_assembler.DEST_MAP[dest]:03b}'
+    jump_bin = f'{hack_assembler.JUMP_MAP[jump]:03b}'
+    return f'111{hack_assembler.COMP_MAP[comp]}{dest_bin}{jump_bin}'
+
+
+def legacy_classify(lines: List[str]) -> None:
+    '''
+    Line classification as done by both passes of the original assembler
+    '''
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('//') or line.isspace():
+            continue
+        elif line.startswith('('):
+            re.search(r'\((.*)\)', line).group(1)
+
+    for line in lines:
+        line = line.strip()
+        line = line.split('//')[0]
+        line = line.strip()
+        if not line or line.startswith('//') or line.startswith('(') or line.isspace():
+            continue
+        elif line.startswith('@'):
+            pass
+
+
+def load_instructions(path: str) -> Tuple[List[str], Dict[str, int]]:
+    '''
+    Returns the instructions in path with comments and labels removed, and the symbol table after the first pass.
+    '''
+    with open(path, 'r') as f:
+        tokens = list(hack_assembler.tokenise(f))
+    assembler = hack_assembler.Assembler()
+    assembler.first_pass(tokens)
+    instructions = [text if kind == hack_assembler.C_INSTRUCTION else f'@{text}' for kind, text, _ in tokens
+                    if kind != hack_assembler.LABEL]
+    return instructions, assembler.symbols
+
+
+def fresh_assembler(symbols: Dict[str, int]) -> hack_assembler.Assembler:
+    assembler = hack_assembler.Assembler()
+    assembler.symbols.update(symbols)
+    return assembler
+
+
+def report(name: str, func: Callable[[], None], n_instructions: int) -> float:
+    best = min(timeit.repeat(func, number=1, repeat=REPEAT))
+    rate = n_instructions / best
+    print(f'{name:<30} {best * 1000:9.2f} ms {rate:14,.0f} instructions/s')
+    return rate
+
+
+def bench_encoding(instructions: List[str], symbols: Dict[str, int]) -> None:
+    print(f'encoding {len(instructions)} instructions, best of {REPEAT}')
+
+    def before():
+        program_symbols = dict(symbols)
+        for line in instructions:
+            if line.startswith('@'):
+                legacy_parse_a_instruct(line, program_symbols)
+            else:
+                legacy_parse_c_instruct(line)
+
+    def after_text():
+        parse_a, parse_c = fresh_assembler(symbols).parse_a_instruct, hack_assembler.parse_c_instruct
+        for line in instructions:
+            if line.startswith('@'):
+                parse_a(line)
+            else:
+                parse_c(line)
+
+    def after_words():
+        encode_a, encode_c = fresh_assembler(symbols).encode_a_instruct, hack_assembler.encode_c_instruct
+        for line in instructions:
+            if line.startswith('@'):
+                encode_a(line)
+            else:
+                encode_c(line)
+
+    before_rate = report('before: split + f-strings', before, len(instructions))
+    text_rate = report('after: table lookup (text)', after_text, len(instructions))
+    words_rate = report('after: table lookup (words)', after_words, len(instructions))
+    print(f'speedup: {text_rate / before_rate:.2f}x text, {words_rate / before_rate:.2f}x words')
+
+
+def bench_lexer(path: str, n_lines: int = GENERATED_LINES) -> None:
+    with open(path, 'r') as f:
+        source = f.readlines()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        generated_path = os.path.join(tmp_dir, 'generated.asm')
+        with open(generated_path, 'w') as f:
+            for i in range(n_lines):
+                f.write(source[i % len(source)])
+        with open(generated_path, 'r') as f:
+            lines = f.readlines()
+
+    print(f'classifying {len(lines)} generated lines, best of {REPEAT}')
+    before = min(timeit.repeat(lambda: legacy_classify(lines), number=1, repeat=REPEAT))
+    after = min(timeit.repeat(lambda: list(hack_assembler.tokenise(lines)), number=1, repeat=REPEAT))
+    print(f'{"before: classify in each pass":<30} {before * 1000:9.2f} ms {len(lines) / before:14,.0f} lines/s')
+    print(f'{"after: tokenise once":<30} {after * 1000:9.2f} ms {len(lines) / after:14,.0f} lines/s')
+    print(f'speedup: {before / after:.2f}x')
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_ASM
+    instructions, symbols = load_instructions(path)
+    bench_encoding(instructions, symbols)
+    print()
+    bench_lexer(path)
+
+
+if __name__ == '__main__':
+    main()
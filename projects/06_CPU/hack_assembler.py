@@ -1,7 +1,21 @@
+import argparse
+import hashlib
+import json
+import mmap
 import re
 import os
+import shutil
+import struct
+import sys
+import time
 
-symbols = {
+from array import array
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from types import MappingProxyType
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+
+PREDEFINED_SYMBOLS = MappingProxyType({
     'SP': 0,
     'LCL': 1,
     'ARG': 2,
@@ -25,7 +39,7 @@ symbols = {
     'R15': 15,
     'SCREEN': 16384,
     'KBD': 24576
-}
+})
 
 COMP_MAP = {
     "0": "0101010",
@@ -79,91 +93,495 @@ JUMP_MAP = {
     'JMP': 7
 }
 
-last_free_memory = 16
+VARIABLE_BASE_ADDRESS = 16
+# an A-instruction holds a 15 bit constant, the top bit of the word marks a C-instruction
+MAX_A_CONSTANT = 2 ** 15 - 1
+# instructions the ROM holds, so every instruction address fits in an A-instruction
+ROM_SIZE = MAX_A_CONSTANT + 1
+
+
+# token kinds yielded by tokenise
+LABEL = 0
+A_INSTRUCTION = 1
+C_INSTRUCTION = 2
+
+Token = Tuple[int, str, int]
+
+_LABEL_PATTERN = re.compile(r'\(([^()\s]+)\)$')
+
+
+def tokenise(lines: Iterable[str]) -> Iterator[Token]:
+    '''
+    Classifies each line in a single scan, skipping blank and comment lines and yielding a (kind, text, line_number)
+    token for each label, A-instruction and C-instruction. text is the label name, the A-instruction operand without
+    the @, or the C-instruction mnemonic.
+    '''
+    for line_number, line in enumerate(lines, 1):
+        line = line.split('//', 1)[0].strip()
+        if not line:
+            continue
+        first_char = line[0]
+        if first_char == '@':
+            yield A_INSTRUCTION, line[1:], line_number
+        elif first_char == '(':
+            result = _LABEL_PATTERN.match(line)
+            if result is None:
+                raise ValueError(f'line {line_number}: invalid label: {line}')
+            yield LABEL, result.group(1), line_number
+        else:
+            yield C_INSTRUCTION, line, line_number
+
 
-def remove_comments(command: str):
-    command = command.strip()
-    command = command.split('//')[0]
-    return command.strip()
+def _build_c_instruction_map() -> Dict[str, int]:
+    '''
+    Every dest=comp;jump combination, keyed by its mnemonic text, mapped to its encoded 16 bit word.
+    '''
+    c_instruction_map = {}
+    for dest, dest_int in DEST_MAP.items():
+        for comp, comp_bin in COMP_MAP.items():
+            for jump, jump_int in JUMP_MAP.items():
+                mnemonic = comp if dest is None else f'{dest}={comp}'
+                mnemonic = mnemonic if jump is None else f'{mnemonic};{jump}'
+                c_instruction_map[mnemonic] = 0b111 << 13 | int(comp_bin, 2) << 6 | dest_int << 3 | jump_int
+    return c_instruction_map
 
 
-def parse_a_instruct(command: str):
-    command = command.strip('@')
-    global last_free_memory
-    if command not in symbols and not command.isdigit():
-        symbols[command] = last_free_memory
-        last_free_memory += 1
-    value = int(command) if command.isdigit() else symbols[command]
-    binary = f'0{value:015b}'
-    return binary
+C_INSTRUCTION_MAP = _build_c_instruction_map()
+
+# text of every word encoded so far, seeded with all C-instructions
+_word_text: Dict[int, str] = {word: f'{word:016b}' for word in C_INSTRUCTION_MAP.values()}
+# int value of every numeric A-instruction operand seen so far
+_a_constants: Dict[str, int] = {}
+
+
+def word_to_text(word: int) -> str:
+    try:
+        return _word_text[word]
+    except KeyError:
+        text = _word_text[word] = f'{word:016b}'
+        return text
+
+
+def encode_c_instruct(command: str) -> int:
+    try:
+        return C_INSTRUCTION_MAP[command]
+    except KeyError:
+        normalised = ''.join(command.split())
+        if normalised not in C_INSTRUCTION_MAP:
+            raise ValueError(f'Invalid C-instruction: {command}')
+        return C_INSTRUCTION_MAP[normalised]
 
 
 def parse_c_instruct(command: str):
-    if '=' not in command:
-        dest = None
-    else:
-        dest, command = command.split('=')
+    return word_to_text(encode_c_instruct(command))
 
-    if ';' not in command:
-        jump = None
-        comp = command
-    else:
-        comp, jump = command.split(';')
 
+HACK_LINE_WIDTH = 17  # 16 binary digits + newline
+BINARY_WORD = struct.Struct('<H')
+OUTPUT_FORMATS = ('hack', 'bin')
 
-    dest_int = DEST_MAP[dest]
-    comp_bin = COMP_MAP[comp]
-    jump_int = JUMP_MAP[jump]
+# bump when a change to the assembler changes its output, invalidating cached results
+ASSEMBLER_VERSION = '2'
+DEFAULT_CACHE_BYTES = 64 * 2 ** 20
 
-    dest_bin = f'{dest_int:03b}'
-    jump_bin = f'{jump_int:03b}'
 
-    return f'111{comp_bin}{dest_bin}{jump_bin}'
+class PassStats(namedtuple('PassStats', ['name', 'seconds', 'lines', 'instructions', 'symbols'])):
+    __slots__ = ()
 
+    @property
+    def instructions_per_second(self) -> float:
+        return self.instructions / self.seconds if self.seconds else float('inf')
 
-def main():
-    file = '/Users/kamsandhu/Documents/Code/prjoects_non_git/nand2tetris/projects/06/pong/Pong.asm'
-    with open(file, 'r') as f:
-        lines = f.readlines()
-
-    # first pass
-    command_count = 0
-    for line in lines:
-        line = line.strip()
-        if not line or line.startswith('//')  or line.isspace():
-            continue
-        elif line.startswith('('):
-            result = re.search('\((.*)\)', line)
-            symbol = result.group(1)
-            symbols[symbol] = command_count
-        else:
-            command_count +=1
-
-    output_list = []
-    # 2nd pass
-    for line in lines:
-        print(f'parsing: {line.strip()}')
-        line = remove_comments(line)
-        if not line or line.startswith('//') or line.startswith('(') or line.isspace():
-            continue
-        elif line.startswith('@'):
-            output_list.append(parse_a_instruct(line))
-        else:
-            output_list.append(parse_c_instruct(line))
+    def __str__(self) -> str:
+        return (f'{self.name}: {self.seconds * 1000:.2f} ms, {self.lines} lines, {self.instructions} instructions, '
+                f'{self.symbols} symbols, {self.instructions_per_second:,.0f} instructions/s')
+
+
+Reporter = Optional[Callable[[PassStats], None]]
+
+
+def _check_address(symbol: str, address: int) -> int:
+    if address > MAX_A_CONSTANT:
+        raise ValueError(f'address {address} of {symbol} is greater than maximum {MAX_A_CONSTANT}')
+    return address
+
+
+def _text_word_bytes(word: int) -> bytes:
+    return f'{word_to_text(word)}\n'.encode()
+
+
+class Assembler:
+    '''
+    Assembles Hack programs. Each instance owns its symbol table, seeded from PREDEFINED_SYMBOLS, so any number of
+    programs can be assembled in one process. An instance holds the labels and variables of the program it last
+    assembled, use a new instance for each program.
+    '''
+
+    def __init__(self) -> None:
+        self.symbols: Dict[str, int] = dict(PREDEFINED_SYMBOLS)
+        self._last_free_memory = VARIABLE_BASE_ADDRESS
+
+    def _allocate_variable(self, symbol: str) -> int:
+        address = self.symbols[symbol] = self._last_free_memory
+        self._last_free_memory += 1
+        return address
+
+    def _report(self, reporter: Reporter, name: str, start: float, lines: int, instructions: int) -> None:
+        if reporter is not None:
+            reporter(PassStats(name, time.perf_counter() - start, lines, instructions, len(self.symbols)))
+
+    def encode_a_instruct(self, command: str) -> int:
+        return self.encode_a_symbol(command.strip('@'))
+
+    def encode_a_symbol(self, command: str) -> int:
+        try:
+            return _a_constants[command]
+        except KeyError:
+            pass
+
+        if command.isdigit():
+            value = int(command)
+            if value > MAX_A_CONSTANT:
+                raise ValueError(f'A-instruction constant {command} is greater than maximum {MAX_A_CONSTANT}')
+            _a_constants[command] = value
+            return value
+
+        try:
+            address = self.symbols[command]
+        except KeyError:
+            address = self._allocate_variable(command)
+        return _check_address(command, address)
+
+    def parse_a_instruct(self, command: str) -> str:
+        return word_to_text(self.encode_a_instruct(command))
+
+    def first_pass(self, tokens: Iterable[Token]) -> int:
+        command_count = 0
+        line_number = 0
+        try:
+            for kind, text, line_number in tokens:
+                if kind == LABEL:
+                    self.symbols[text] = _check_address(text, command_count)
+                elif command_count == ROM_SIZE:
+                    raise ValueError(f'program is longer than the {ROM_SIZE} instructions of ROM')
+                else:
+                    command_count +=1
+        except ValueError as e:
+            raise ValueError(f'line {line_number}: {e}') from e
+        return command_count
+
+    def second_pass(self, tokens: Iterable[Token]) -> array:
+        words = array('H')
+        encode_a_symbol = self.encode_a_symbol
+        kind, text, line_number = None, None, 0
+        try:
+            for kind, text, line_number in tokens:
+                if kind == A_INSTRUCTION:
+                    words.append(encode_a_symbol(text))
+                elif kind == C_INSTRUCTION:
+                    words.append(encode_c_instruct(text))
+        except (ValueError, OverflowError) as e:
+            raise ValueError(f'line {line_number}: {e}') from e
+        return words
+
+    def assemble_words(self, lines: List[str], reporter: Reporter = None) -> array:
+        '''
+        Two pass assembly of lines, which are tokenised once and the tokens shared by both passes. If given, reporter
+        is called with the PassStats of each pass once it completes.
+        '''
+        start = time.perf_counter()
+        tokens = list(tokenise(lines))
+        command_count = self.first_pass(tokens)
+        self._report(reporter, 'first pass', start, len(lines), command_count)
 
-    file_name = os.path.basename(file)
+        start = time.perf_counter()
+        words = self.second_pass(tokens)
+        self._report(reporter, 'second pass', start, len(lines), len(words))
+        return words
+
+    def assemble(self, lines: List[str], reporter: Reporter = None) -> List[str]:
+        return [word_to_text(word) for word in self.assemble_words(lines, reporter)]
+
+    def assemble_streaming(self, in_file: TextIO, out_file: BinaryIO, binary: bool = False,
+                           reporter: Reporter = None) -> int:
+        '''
+        Single pass assembly, reading in_file line by line and writing each word to out_file as soon as it is encoded.
+
+        A-instructions that reference a symbol which is not known yet (a forward label or a variable) are written as a
+        placeholder and recorded in a fixup table. Once the whole source has been read the fixups are resolved in order
+        of first use, so variables get the same addresses as the two pass assembler gives them, and the placeholders
+        are back-patched in place. out_file must be seekable. Words are written as .hack text lines, or as a packed
+        binary ROM image if binary is set. If given, reporter is called with the PassStats of the streaming pass and of
+        the back-patching. Returns the number of instructions written.
+        '''
+        symbols = self.symbols
+        fixups: Dict[str, List[int]] = {}
+        # line of the first use of each symbol in fixups, for errors raised while back-patching
+        fixup_lines: Dict[str, int] = {}
+        word_bytes = BINARY_WORD.pack if binary else _text_word_bytes
+        word_width = BINARY_WORD.size if binary else HACK_LINE_WIDTH
+        placeholder = word_bytes(0)
+
+        start = time.perf_counter()
+        line_number = 0
+        command_count = 0
+        try:
+            for kind, text, line_number in tokenise(in_file):
+                if kind == LABEL:
+                    symbols[text] = _check_address(text, command_count)
+                    continue
+                elif command_count == ROM_SIZE:
+                    raise ValueError(f'program is longer than the {ROM_SIZE} instructions of ROM')
+                elif kind == A_INSTRUCTION:
+                    if text.isdigit() or text in symbols:
+                        out_file.write(word_bytes(self.encode_a_symbol(text)))
+                    else:
+                        fixups.setdefault(text, []).append(command_count)
+                        fixup_lines.setdefault(text, line_number)
+                        out_file.write(placeholder)
+                else:
+                    out_file.write(word_bytes(encode_c_instruct(text)))
+                command_count += 1
+        except (ValueError, struct.error) as e:
+            raise ValueError(f'line {line_number}: {e}') from e
+
+        self._report(reporter, 'streaming pass', start, line_number, command_count)
+
+        start = time.perf_counter()
+        end = out_file.tell()
+        for symbol, positions in fixups.items():
+            address = symbols[symbol] if symbol in symbols else self._allocate_variable(symbol)
+            try:
+                word = word_bytes(_check_address(symbol, address))
+            except ValueError as e:
+                raise ValueError(f'line {fixup_lines[symbol]}: {e}') from e
+            for position in positions:
+                out_file.seek(position * word_width)
+                out_file.write(word)
+        out_file.seek(end)
+        self._report(reporter, 'back-patching', start, 0, sum(len(positions) for positions in fixups.values()))
+
+        return command_count
+
+
+AssemblyResult = namedtuple('AssemblyResult',
+                            ['in_path', 'out_path', 'instructions', 'symbols', 'seconds', 'error', 'cached'])
+
+
+class AssemblyCache:
+    '''
+    On disk cache of assembled programs, keyed by a hash of the source, the output format and ASSEMBLER_VERSION. Each
+    entry is the assembled artifact plus a json file holding its instruction count and symbol table. Entries are evicted
+    least recently used first once the cache holds more than max_bytes. Safe to share between processes.
+    '''
+
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_CACHE_BYTES) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(in_path: str, output_format: str) -> str:
+        digest = hashlib.sha256(f'{ASSEMBLER_VERSION}:{output_format}:'.encode())
+        with open(in_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                digest.update(chunk)
+        return f'{digest.hexdigest()}.{output_format}'
+
+    def _paths(self, key: str) -> Tuple[str, str]:
+        artifact_path = os.path.join(self.directory, key)
+        return artifact_path, f'{artifact_path}.json'
+
+    def get(self, key: str, out_path: str) -> Optional[dict]:
+        '''
+        Copies the cached artifact for key to out_path and returns its metadata, or returns None on a miss.
+        '''
+        artifact_path, metadata_path = self._paths(key)
+        try:
+            with open(metadata_path, 'r') as f:
+                metadata = json.load(f)
+            shutil.copyfile(artifact_path, out_path)
+            # mtime records when an entry was last used
+            os.utime(metadata_path)
+        except (OSError, ValueError):
+            return None
+        return metadata
+
+    def put(self, key: str, artifact_path: str, instructions: int, symbols: Dict[str, int]) -> None:
+        cached_artifact_path, metadata_path = self._paths(key)
+        suffix = f'.{os.getpid()}.tmp'
+        shutil.copyfile(artifact_path, cached_artifact_path + suffix)
+        os.replace(cached_artifact_path + suffix, cached_artifact_path)
+        # the metadata is written last, an entry only counts once it exists
+        with open(metadata_path + suffix, 'w') as f:
+            json.dump({'instructions': instructions, 'symbols': symbols}, f)
+        os.replace(metadata_path + suffix, metadata_path)
+        self._evict()
+
+    def _evict(self) -> None:
+        entries = []
+        total_bytes = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.json'):
+                continue
+            artifact_path = entry.path[:-len('.json')]
+            try:
+                size = entry.stat().st_size + os.path.getsize(artifact_path)
+                entries.append((entry.stat().st_mtime, size, artifact_path, entry.path))
+            except OSError:
+                continue
+            total_bytes += size
+
+        for _, size, artifact_path, metadata_path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            for path in (metadata_path, artifact_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total_bytes -= size
+
+
+def output_path(in_path: str, output_format: str = 'hack', out_dir: Optional[str] = None) -> str:
+    file_name = os.path.basename(in_path)
     file_name_wo_extenstion = os.path.splitext(file_name)[0]
+    return os.path.join(out_dir or '', f'{file_name_wo_extenstion}.{output_format}')
 
-    with open(f'{file_name_wo_extenstion}.hack', 'w') as f:
-        for line in output_list:
-            f.write(line)
-            f.write('\n')
 
-if __name__ == '__main__':
-    main()
+def assemble_file(in_path: str, out_path: str, output_format: str = 'hack', streaming: bool = False,
+                  reporter: Reporter = None, cache: Optional[AssemblyCache] = None) -> AssemblyResult:
+    '''
+    Assembles in_path into out_path with a fresh Assembler. If a cache is given, unchanged sources are copied from it
+    rather than assembled. Errors are returned in the result rather than raised, so one bad file does not abort a batch.
+    '''
+    start = time.perf_counter()
+    assembler = Assembler()
+    binary = output_format == 'bin'
+    try:
+        if cache is not None:
+            key = cache.key(in_path, output_format)
+            metadata = cache.get(key, out_path)
+            if metadata is not None:
+                return AssemblyResult(in_path, out_path, metadata['instructions'], len(metadata['symbols']),
+                                      time.perf_counter() - start, None, True)
+
+        if streaming:
+            with open(in_path, 'r') as in_file, open(out_path, 'wb+') as out_file:
+                try:
+                    instructions = assembler.assemble_streaming(in_file, out_file, binary=binary, reporter=reporter)
+                except Exception:
+                    # words are written as they are encoded, do not leave a truncated ROM behind
+                    out_file.close()
+                    os.remove(out_path)
+                    raise
+        else:
+            with open(in_path, 'r') as f:
+                lines = f.readlines()
+
+            words = assembler.assemble_words(lines, reporter)
+            instructions = len(words)
+            if binary:
+                write_binary_rom(words, out_path)
+            else:
+                with open(out_path, 'w') as f:
+                    for word in words:
+                        f.write(word_to_text(word))
+                        f.write('\n')
+
+        if cache is not None:
+            cache.put(key, out_path, instructions, assembler.symbols)
+    except (OSError, KeyError, ValueError) as e:
+        return AssemblyResult(in_path, out_path, 0, len(assembler.symbols), time.perf_counter() - start,
+                              f'{type(e).__name__}: {e}', False)
+
+    return AssemblyResult(in_path, out_path, instructions, len(assembler.symbols), time.perf_counter() - start, None,
+                          False)
+
+
+def assemble_files(in_paths: List[str], output_format: str = 'hack', streaming: bool = False,
+                   out_dir: Optional[str] = None, processes: Optional[int] = None,
+                   cache: Optional[AssemblyCache] = None) -> List[AssemblyResult]:
+    '''
+    Assembles each of in_paths across a pool of processes, returning an AssemblyResult per file in the order given.
+    '''
+    out_paths = [output_path(in_path, output_format, out_dir) for in_path in in_paths]
+    n_files = len(in_paths)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(assemble_file, in_paths, out_paths, [output_format] * n_files, [streaming] * n_files,
+                                 [None] * n_files, [cache] * n_files))
+
+
+def write_binary_rom(words: array, path: str) -> None:
+    '''
+    Writes words as a raw ROM image, one little endian 16 bit word per instruction.
+    '''
+    if sys.byteorder == 'big':
+        words = array('H', words)
+        words.byteswap()
+    with open(path, 'wb') as f:
+        words.tofile(f)
+
 
+def read_binary_rom(path: str) -> array:
+    words = array('H')
+    with open(path, 'rb') as f:
+        words.frombytes(f.read())
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return words
 
 
+def map_binary_rom(path: str) -> memoryview:
+    '''
+    Maps a binary ROM image into memory without parsing it. The returned view indexes words directly, and is only valid
+    on little endian hosts, use read_binary_rom otherwise.
+    '''
+    with open(path, 'rb') as f:
+        rom = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(rom).cast('H')
 
 
+def read_hack_rom(path: str) -> array:
+    with open(path, 'r') as f:
+        return array('H', (int(line, 2) for line in f if line.strip()))
 
+
+def main():
+    parser = argparse.ArgumentParser(description='Assemble Hack .asm files into .hack files')
+    parser.add_argument('files', nargs='+', help='paths to the .asm files')
+    parser.add_argument('--streaming', action='store_true',
+                        help='assemble in a single pass, back-patching forward references (low memory)')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='hack',
+                        help='hack: one line of binary text per word, bin: packed little endian 16 bit words')
+    parser.add_argument('--stats', action='store_true',
+                        help='print timings, instruction counts and symbol table size of each pass to stderr')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='number of processes used when assembling several files (default: one per core)')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory of an output cache, unchanged sources are served from it instead of assembled')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_BYTES // 2 ** 20,
+                        help='size in MiB above which least recently used cache entries are evicted')
+    args = parser.parse_args()
+    cache = AssemblyCache(args.cache_dir, args.cache_size * 2 ** 20) if args.cache_dir else None
+
+    if len(args.files) == 1:
+        file = args.files[0]
+        reporter = (lambda stats: print(stats, file=sys.stderr)) if args.stats else None
+        results = [assemble_file(file, output_path(file, args.format), args.format, args.streaming, reporter, cache)]
+    else:
+        results = assemble_files(args.files, args.format, args.streaming, processes=args.jobs, cache=cache)
+
+    for result in results:
+        if result.error is not None:
+            print(f'{result.in_path}: {result.error}', file=sys.stderr)
+        elif args.stats:
+            print(f'{result.in_path} -> {result.out_path}: {result.instructions} instructions, {result.symbols} symbols, '
+                  f'{result.seconds * 1000:.2f} ms{" (cached)" if result.cached else ""}', file=sys.stderr)
+
+    if any(result.error is not None for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
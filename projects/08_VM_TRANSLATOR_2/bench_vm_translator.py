@@ -0,0 +1,151 @@
+'''
+Benchmarks for vm_translator.py
+
+python bench_vm_translator.py [copies]
+'''
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+from types import ModuleType
+from typing import Callable, List, Optional, Tuple
+
+import vm_translator
+
+OS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'tools', 'OS')
+REPEAT = 3
+COPIES = 100
+CALLS = 100_000
+# a function with no labels or jumps is one basic block for the peephole optimiser, as long as its body
+STRAIGHT_LINE_CODE = 'push local 0\npush local 1\nadd\npush local 2\nadd\npop local 3\n'
+STRAIGHT_LINE_COPIES = (50, 100, 200, 400, 800)
+
+# arguments each command is benchmarked with, commands not listed take none
+COMMAND_ARGS = {
+    'push': ['local 2', 'constant 7', 'temp 3', 'static 1', 'pointer 0'],
+    'pop': ['argument 1', 'temp 3', 'static 1', 'pointer 1'],
+    'if-goto': ['LOOP'],
+    'goto': ['LOOP'],
+    'label': ['LOOP'],
+    'call': ['Main.run 2'],
+    'function': ['Main.run 3'],
+}
+
+
+def make_synthetic_dir(directory: str, copies: int = COPIES) -> List[str]:
+    '''
+    Fills directory with copies of the OS .vm files, returns their paths in translation order.
+    '''
+    for file in os.listdir(OS_DIR):
+        name, extension = os.path.splitext(file)
+        if extension != '.vm':
+            continue
+        for i in range(copies):
+            shutil.copy(os.path.join(OS_DIR, file), os.path.join(directory, f'{name}{i}{extension}'))
+    return vm_translator.list_vm_files(directory)
+
+
+def legacy_translate(paths: List[str], out_path: str) -> None:
+    '''
+    Translation as done by the original main, every line is kept until the end and written with its own write call.
+    '''
+    output_lines = []
+    for path in paths:
+        with open(path, 'r') as f:
+            lines = f.readlines()
+        context = vm_translator.TranslationContext(os.path.splitext(os.path.basename(path))[0])
+        for line in lines:
+            if line.startswith('//') or not line or line.isspace():
+                continue
+            output_lines.append(f'// {line[:-1]}')
+            command = vm_translator.parse_command(line)
+            output_lines.extend(vm_translator.HACK_COMMAND_GENERATORS[command.opcode](context, command))
+
+    with open(out_path, 'w') as f:
+        for line in output_lines:
+            f.write(f'{line}\n')
+
+
+def streaming_translate(paths: List[str], out_path: str, processes: Optional[int] = 1) -> None:
+    with open(out_path, 'w') as f:
+        vm_translator.write_lines(vm_translator.translate_files(paths, processes=processes), f)
+
+
+def parallel_translate(paths: List[str], out_path: str) -> None:
+    streaming_translate(paths, out_path, processes=None)
+
+
+def peak_memory(func: Callable[[], None]) -> int:
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def bench_commands(translator: ModuleType = vm_translator, calls: int = CALLS) -> None:
+    '''
+    Throughput of each code generator in translator.HACK_COMMAND_GENERATORS.
+    '''
+    print(f'generating each command {calls} times, best of {REPEAT}')
+    for opcode, generator in translator.HACK_COMMAND_GENERATORS.items():
+        name = translator.OPCODE_NAMES[opcode]
+        for args in COMMAND_ARGS.get(name, ['']):
+            context = translator.TranslationContext('Main')
+            command = translator.parse_command(f'{name} {args}'.strip())
+            best = min(timeit.repeat(lambda: generator(context, command), number=calls, repeat=REPEAT))
+            label = f'{name} {args.split(" ")[0]}' if name in ('push', 'pop') else name
+            print(f'{label:<16} {best / calls * 1e9:9.0f} ns {calls / best:14,.0f} commands/s')
+
+
+def bench_pipeline(copies: int = COPIES) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        vm_dir = os.path.join(tmp_dir, 'vm')
+        os.mkdir(vm_dir)
+        paths = make_synthetic_dir(vm_dir, copies)
+        out_path = os.path.join(tmp_dir, 'out.asm')
+        n_commands = 0
+        for path in paths:
+            with open(path, 'r') as f:
+                n_commands += sum(1 for _ in vm_translator.read_commands(f))
+        print(f'translating {len(paths)} files, {n_commands} commands, best of {REPEAT} '
+              f'(peak memory of the main process)')
+
+        for name, translate in (('before: list + write per line', legacy_translate),
+                                ('after: streaming + chunked', streaming_translate),
+                                (f'parallel: {os.cpu_count()} processes', parallel_translate)):
+            best = min(timeit.repeat(lambda: translate(paths, out_path), number=1, repeat=REPEAT))
+            peak = peak_memory(lambda: translate(paths, out_path))
+            print(f'{name:<30} {best * 1000:9.2f} ms {n_commands / best:12,.0f} commands/s '
+                  f'{peak / 2 ** 20:9.2f} MiB peak')
+
+
+def bench_peephole(copies: Tuple[int, ...] = STRAIGHT_LINE_COPIES) -> None:
+    '''
+    Peephole optimisation of functions made of copies of STRAIGHT_LINE_CODE, a single block of growing length, time per
+    instruction should not grow with the block.
+    '''
+    print(f'peephole optimising a straight line function of {", ".join(str(n) for n in copies)} copies, best of {REPEAT}')
+    for n_copies in copies:
+        source = f'function Main.main 4\n{STRAIGHT_LINE_CODE * n_copies}push constant 0\nreturn\n'
+        commands = list(vm_translator.read_commands(source.splitlines()))
+        lines = list(vm_translator.translate_commands(vm_translator.TranslationContext('Main'), commands))
+        best = min(timeit.repeat(lambda: list(vm_translator.PeepholeOptimiser().optimise(lines)), number=1,
+                                 repeat=REPEAT))
+        print(f'{n_copies:>5} copies {len(lines):8} lines {best * 1000:10.2f} ms {len(lines) / best:14,.0f} lines/s')
+
+
+def main():
+    copies = int(sys.argv[1]) if len(sys.argv) > 1 else COPIES
+    bench_commands()
+    print()
+    bench_pipeline(copies)
+    print()
+    bench_peephole()
+
+
+if __name__ == '__main__':
+    main()
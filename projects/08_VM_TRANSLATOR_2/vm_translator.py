@@ -9,90 +9,262 @@ gets value at top of the stack and sets it to D
 '''
 
 
+import argparse
+import hashlib
+import json
 import os
-
-from typing import List
-from uuid import uuid4
-
-
-
-COMMANDS_WITH_2_ARGS = ['push', 'pop']
-COMMANDS_WITH_1_ARG = ['if-goto', 'goto', 'label']
+import re
+import sys
+
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Set, TextIO, Tuple
+
+
+# opcodes of parsed commands, plain ints rather than an IntEnum as enum member lookups are slow in the hot loops
+ADD = 0
+SUB = 1
+NEG = 2
+EQ = 3
+GT = 4
+LT = 5
+AND = 6
+OR = 7
+NOT = 8
+PUSH = 9
+POP = 10
+LABEL = 11
+GOTO = 12
+IF_GOTO = 13
+FUNCTION = 14
+CALL = 15
+RETURN = 16
+# only made by CommandOptimiser
+PUSH_CONSTANT = 17
+UPDATE_TOP = 18
+UPDATE = 19
+MOVE = 20
+COMPUTE = 21
+
+OPCODE_NAMES = ('add', 'sub', 'neg', 'eq', 'gt', 'lt', 'and', 'or', 'not', 'push', 'pop', 'label', 'goto', 'if-goto',
+                'function', 'call', 'return', 'push-constant', 'update-top', 'update', 'move', 'compute')
+OPCODES = {name: opcode for opcode, name in enumerate(OPCODE_NAMES[:RETURN + 1])}
+
+# segments of push and pop
+LOCAL = 0
+ARGUMENT = 1
+THIS = 2
+THAT = 3
+CONSTANT = 4
+STATIC = 5
+TEMP = 6
+POINTER = 7
+
+SEGMENT_NAMES = ('local', 'argument', 'this', 'that', 'constant', 'static', 'temp', 'pointer')
+SEGMENTS = {name: segment for segment, name in enumerate(SEGMENT_NAMES)}
+
+COMMANDS_WITH_2_ARGS = {PUSH, POP, FUNCTION, CALL}
+COMMANDS_WITH_1_ARG = {IF_GOTO, GOTO, LABEL}
+
+SHARED_ROUTINE_PREFIX = 'VM$'
+
+WRITE_CHUNK_LINES = 4096
+
+# statics live between the virtual registers and the stack
+STATIC_BASE_ADDRESS = 16
+STATIC_END_ADDRESS = 255
+
+ENTRY_FUNCTION = 'Sys.init'
+
+# bump when a change to the translator changes its output, invalidating cached translations
+TRANSLATOR_VERSION = '1'
+DEFAULT_CACHE_BYTES = 64 * 2 ** 20
 
 SEGMENT_BASE_MAP = {
-    'local': 1,
-    'argument': 2,
-    'this': 3,
-    'that': 4,
+    LOCAL: 1,
+    ARGUMENT: 2,
+    THIS: 3,
+    THAT: 4,
 }
 
 
+class Command(namedtuple('Command', ['opcode', 'segment', 'index', 'name', 'operands', 'line'],
+                         defaults=(None, 0, '', (), ''))):
+    '''
+    A parsed VM command. push and pop have a segment and index, label, goto and if-goto a name, and function and call
+    a name with the number of locals or arguments as the index. operands holds the other fields of the commands made by
+    CommandOptimiser, and line the text of the command.
+    '''
+
+    __slots__ = ()
+
+
+class TranslationContext:
+    '''
+    State for translating one .vm file. Labels generated for the file are namespaced by its name and numbered from a
+    per file counter, so translating the same input always gives the same output. Commands with long expansions can call
+    a routine shared by the whole program instead, return always does and in compact mode comparisons and call do too.
+    The calls made are counted in shared_routine_calls.
+
+    Statics are the symbols <File>.<i>, allocated by the assembler, unless static_addresses maps each index to a RAM
+    address chosen by the translator. The indexes used are collected in statics_used, and instructions_eliminated counts
+    the instructions saved by optimising the file's commands. cached is set when the file's translation was taken from
+    a TranslationCache.
+    '''
+
+    def __init__(self, file_name: str, compact: bool = False,
+                 static_addresses: Optional[Dict[int, int]] = None) -> None:
+        self.file_name = file_name
+        self.function_name: Optional[str] = None
+        self.compact = compact
+        self.static_addresses = static_addresses
+        self.statics_used: Set[int] = set()
+        self.instructions_eliminated = 0
+        self.shared_routine_calls: Dict[str, int] = Counter()
+        self.cached = False
+        self._label_count = 0
+
+    def next_label(self, prefix: str) -> str:
+        label = f'{self.file_name}${prefix}.{self._label_count}'
+        self._label_count += 1
+        return label
+
+    def scoped_label(self, label: str) -> str:
+        '''
+        The name of a VM label in the assembly, labels are scoped to the function they appear in.
+        '''
+        if self.function_name is None:
+            return label
+        return f'{self.function_name}${label}'
+
+    def static_symbol(self, i: int) -> str:
+        self.statics_used.add(i)
+        if self.static_addresses is None:
+            return f'{self.file_name}.{i}'
+        return str(self.static_addresses[i])
+
+
 def code_to_list(code: str) -> List[str]:
     return [line.strip() for line in code.split('\n') if line.strip() and not line.isspace()]
 
 
-def parse_command(command: str) -> List[str]:
+class _KeepMissing(dict):
 
-    def remove_comments(line: str) -> str:
-        line = line.split('//')[0]
-        return line.strip()
+    def __missing__(self, key: str) -> str:
+        return f'{{{key}}}'
 
-    command = remove_comments(command)
-    parts = command.split(' ')
-    if parts[0] in COMMANDS_WITH_2_ARGS:
-        assert len(parts) == 3, f'{parts[0]} requires two args'
-    elif parts[0] in COMMANDS_WITH_1_ARG:
-        assert len(parts) == 2, f'{parts[0]} requires one arg'
-    else:
-        assert len(parts) == 1, f'{parts[0]} takes no args, {parts[1:]} were given'
 
-    return parts
+class CodeTemplate:
+    '''
+    Assembly parsed once into a tuple of instructions. Instructions containing {name} are slots, keyword arguments given
+    to the constructor fill the slots known up front and fill() formats the rest, every other instruction is copied as
+    is.
+    '''
 
+    __slots__ = ('instructions', 'slots')
 
-def generate_add_code() -> List[str]:
-    code = f'''
+    def __init__(self, code: str, **params: object) -> None:
+        instructions = code_to_list(code)
+        if params:
+            instructions = [line.format_map(_KeepMissing(params)) if '{' in line else line for line in instructions]
+        self.instructions = tuple(instructions)
+        self.slots = tuple(i for i, line in enumerate(self.instructions) if '{' in line)
+
+    def __len__(self) -> int:
+        return len(self.instructions)
+
+    def fill(self, **params: object) -> List[str]:
+        output = list(self.instructions)
+        for i in self.slots:
+            output[i] = output[i].format_map(params)
+        return output
+
+
+def tokenise_command(line: str) -> List[str]:
+    '''
+    The words of the command on line, split on any run of whitespace with any comment removed. Empty for blank and
+    comment lines.
+    '''
+    return line.split('//', 1)[0].split()
+
+
+def _parse_words(words: List[str]) -> Command:
+    opcode = OPCODES.get(words[0])
+    if opcode is None:
+        raise ValueError(f'unknown command {words[0]}')
+    line = ' '.join(words)
+
+    if opcode in COMMANDS_WITH_2_ARGS:
+        if len(words) != 3:
+            raise ValueError(f'{words[0]} requires two args')
+        if opcode == PUSH or opcode == POP:
+            segment = SEGMENTS.get(words[1])
+            if segment is None:
+                raise ValueError(f'unknown segment {words[1]}')
+            return Command(opcode, segment, int(words[2]), '', (), line)
+        return Command(opcode, None, int(words[2]), words[1], (), line)
+    if opcode in COMMANDS_WITH_1_ARG:
+        if len(words) != 2:
+            raise ValueError(f'{words[0]} requires one arg')
+        return Command(opcode, None, 0, words[1], (), line)
+    if len(words) != 1:
+        raise ValueError(f'{words[0]} takes no args, {words[1:]} were given')
+    return Command(opcode, None, 0, '', (), line)
+
+
+def parse_command(line: str) -> Command:
+    words = tokenise_command(line)
+    if not words:
+        raise ValueError(f'no command in {line!r}')
+    return _parse_words(words)
+
+
+BINARY_OPERATION_CODE = '''
             @0
             A=M-1
             D=M
             @0
             A=M-1
             A=A-1
-            M=D+M
+            M={operation}
             @0
-            M=M-1           
+            M=M-1
             '''
 
-    return code_to_list(code)
-
-
-def generate_sub_code() -> List[str]:
-    code = '''
+UNARY_OPERATION_CODE = '''
             @0
             A=M-1
-            D=M
-            @0
-            A=M-1
-            A=A-1
-            M=M-D
-            @0
-            M=M-1           
+            M={operation}
             '''
 
-    return code_to_list(code)
+ADD_CODE = CodeTemplate(BINARY_OPERATION_CODE, operation='D+M')
+SUB_CODE = CodeTemplate(BINARY_OPERATION_CODE, operation='M-D')
+AND_CODE = CodeTemplate(BINARY_OPERATION_CODE, operation='D&M')
+OR_CODE = CodeTemplate(BINARY_OPERATION_CODE, operation='D|M')
+NEG_CODE = CodeTemplate(UNARY_OPERATION_CODE, operation='-M')
+NOT_CODE = CodeTemplate(UNARY_OPERATION_CODE, operation='!M')
 
 
-def generate_neg_code() -> List[str]:
-    code = '''
-            @0
-            A=M-1
-            M=-M
-           '''
-    return code_to_list(code)
+def generate_add_code(context: TranslationContext, command: Command) -> List[str]:
+    return list(ADD_CODE.instructions)
 
 
-def generate_eq_code() -> List[str]:
-    jump_uuid = f'jump_{str(uuid4())[:5]}'
-    code = f'''
+def generate_sub_code(context: TranslationContext, command: Command) -> List[str]:
+    return list(SUB_CODE.instructions)
+
+
+def generate_neg_code(context: TranslationContext, command: Command) -> List[str]:
+    return list(NEG_CODE.instructions)
+
+
+COMPARISON_JUMPS = {
+    'EQ': 'JEQ',
+    'GT': 'JGT',
+    'LT': 'JLT',
+}
+
+COMPARISON_CODE = CodeTemplate('''
             @0
             A=M-1
             D=M
@@ -101,355 +273,1438 @@ def generate_eq_code() -> List[str]:
             A=A-1
             D=M-D
             M=-1
-            @{jump_uuid}
-            D;JEQ
+            @{label}
+            D;{jump}
             @0
             A=M-1
             A=A-1
             M=0
-            ({jump_uuid})
-            @0 
+            ({label})
+            @0
             M=M-1
-            '''
-    return code_to_list(code)
+            ''')
 
 
-def generate_gt_code() -> List[str]:
-    jump_uuid = f'jump_{str(uuid4())[:5]}'
-    code = f'''
+def _comparison_code(jump_label: str, jump: str) -> List[str]:
+    return COMPARISON_CODE.fill(label=jump_label, jump=jump)
+
+
+def _generate_comparison_code(context: TranslationContext, kind: str) -> List[str]:
+    if context.compact:
+        return generate_shared_routine_call(context, kind)
+    return _comparison_code(context.next_label(kind), COMPARISON_JUMPS[kind])
+
+
+def generate_eq_code(context: TranslationContext, command: Command) -> List[str]:
+    return _generate_comparison_code(context, 'EQ')
+
+
+def generate_gt_code(context: TranslationContext, command: Command) -> List[str]:
+    return _generate_comparison_code(context, 'GT')
+
+
+def generate_lt_code(context: TranslationContext, command: Command) -> List[str]:
+    return _generate_comparison_code(context, 'LT')
+
+
+SHARED_ROUTINE_CALL_CODE = CodeTemplate(f'''
+            @{{return_label}}
+            D=A
+            @{SHARED_ROUTINE_PREFIX}{{routine}}
+            0;JMP
+            ({{return_label}})
+            ''')
+
+
+def generate_shared_routine_call(context: TranslationContext, routine: str) -> List[str]:
+    '''
+    Jumps to a shared routine with the return address in D, the routine saves it in R13 and jumps back to it when done.
+    '''
+    context.shared_routine_calls[routine] += 1
+    return SHARED_ROUTINE_CALL_CODE.fill(return_label=context.next_label('RET'), routine=routine)
+
+
+def generate_and_code(context: TranslationContext, command: Command) -> List[str]:
+    return list(AND_CODE.instructions)
+
+
+def generate_or_code(context: TranslationContext, command: Command) -> List[str]:
+    return list(OR_CODE.instructions)
+
+
+def generate_not_code(context: TranslationContext, command: Command) -> List[str]:
+    return list(NOT_CODE.instructions)
+
+
+PUSH_D_CODE = '''
             @0
-            A=M-1
+            A=M
+            M=D
+            @0
+            M=M+1
+            '''
+PUSH_D_INSTRUCTIONS = CodeTemplate(PUSH_D_CODE).instructions
+
+PUSH_SEGMENT_CODE = '''
+            @{base}
+            D=M
+            @{i}
+            D=D+A
+            A=D
             D=M
+            ''' + PUSH_D_CODE
+
+PUSH_FIXED_SEGMENT_CODE = '''
+            @{i}
+            D=A
+            @{base}
+            A=D+A
+            D=M
+            ''' + PUSH_D_CODE
+
+PUSH_CODE = {
+    **{segment: CodeTemplate(PUSH_SEGMENT_CODE, base=base) for segment, base in SEGMENT_BASE_MAP.items()},
+    CONSTANT: CodeTemplate('''
+            @{i}
+            D=A
+            ''' + PUSH_D_CODE),
+    TEMP: CodeTemplate(PUSH_FIXED_SEGMENT_CODE, base=5),
+    STATIC: CodeTemplate('''
+            @{static}
+            D=M
+            ''' + PUSH_D_CODE),
+    POINTER: CodeTemplate(PUSH_FIXED_SEGMENT_CODE, base=3),
+}
+
+POP_TO_R13_ADDRESS_CODE = '''
+            @13
+            M=D
             @0
             A=M-1
-            A=A-1
-            D=M-D
-            M=-1
-            @{jump_uuid}
-            D;JGT
+            D=M
+            @13
+            A=M
+            M=D
             @0
-            A=M-1
-            A=A-1
-            M=0
-            ({jump_uuid})
-            @0 
             M=M-1
             '''
-    return code_to_list(code)
 
-
-def generate_lt_code() -> List[str]:
-    jump_uuid = f'jump_{str(uuid4())[:5]}'
-    code = f'''
-            @0
-            A=M-1
+POP_CODE = {
+    **{segment: CodeTemplate('''
+            @{base}
             D=M
+            @{i}
+            D=D+A
+            ''' + POP_TO_R13_ADDRESS_CODE, base=base) for segment, base in SEGMENT_BASE_MAP.items()},
+    TEMP: CodeTemplate('''
+            @5
+            D=A
+            @{i}
+            D=D+A
+            ''' + POP_TO_R13_ADDRESS_CODE),
+    STATIC: CodeTemplate('''
             @0
             A=M-1
-            A=A-1
-            D=M-D
-            M=-1
-            @{jump_uuid}
-            D;JLT
+            D=M
+            @{static}
+            M=D
             @0
-            A=M-1
-            A=A-1
-            M=0
-            ({jump_uuid})
-            @0 
             M=M-1
-            '''
-    return code_to_list(code)
+            '''),
+    POINTER: CodeTemplate('''
+            @{i}
+            D=A
+            @3
+            D=D+A
+            ''' + POP_TO_R13_ADDRESS_CODE),
+}
 
 
-def generate_and_code() -> List[str]:
-    code = '''
+def generate_push_code(context: TranslationContext, command: Command) -> List[str]:
+    if command.segment == STATIC:
+        return PUSH_CODE[STATIC].fill(static=context.static_symbol(command.index))
+    return PUSH_CODE[command.segment].fill(i=command.index)
+
+
+def generate_pop_code(context: TranslationContext, command: Command) -> List[str]:
+    if command.segment not in POP_CODE:
+        raise ValueError(f'{SEGMENT_NAMES[command.segment]} not supported for pop')
+    if command.segment == STATIC:
+        return POP_CODE[STATIC].fill(static=context.static_symbol(command.index))
+    return POP_CODE[command.segment].fill(i=command.index)
+
+
+IF_GO_TO_CODE = CodeTemplate('''
             @0
-            A=M-1
+            AM=M-1
+            D=M
+            @{label}
+            D;JNE
+            ''')
+
+GO_TO_CODE = CodeTemplate('''
+            @{label}
+            0;JMP
+            ''')
+
+
+def generate_if_go_to_code(context: TranslationContext, command: Command) -> List[str]:
+    return IF_GO_TO_CODE.fill(label=context.scoped_label(command.name))
+
+
+def generate_go_to_code(context: TranslationContext, command: Command) -> List[str]:
+    return GO_TO_CODE.fill(label=context.scoped_label(command.name))
+
+
+def generate_label_code(context: TranslationContext, command: Command) -> List[str]:
+    return [f'({context.scoped_label(command.name)})']
+
+
+# pushes LCL, ARG, THIS and THAT, the return address has already been pushed
+SAVE_FRAME_CODE = ''.join(f'''
+            @{segment_base}
             D=M
+            ''' + PUSH_D_CODE for segment_base in (1, 2, 3, 4))
+SAVE_FRAME_INSTRUCTIONS = CodeTemplate(SAVE_FRAME_CODE).instructions
+
+INLINE_CALL_CODE = CodeTemplate('''
+            @{return_label}
+            D=A
+            ''' + PUSH_D_CODE + SAVE_FRAME_CODE + '''
             @0
-            A=M-1
-            A=A-1
-            M=D&M
+            D=M
+            @{frame_size}
+            D=D-A
+            @2
+            M=D
             @0
-            M=M-1           
-            '''
+            D=M
+            @1
+            M=D
+            @{function_name}
+            0;JMP
+            ({return_label})
+            ''')
 
-    return code_to_list(code)
+COMPACT_CALL_CODE = CodeTemplate('''
+            @{n_args}
+            D=A
+            @14
+            M=D
+            @{function_name}
+            D=A
+            @15
+            M=D
+            ''')
 
 
-def generate_or_code() -> List[str]:
-    code = '''
-            @0
-            A=M-1
+def _inline_call_code(context: TranslationContext, function_name: str, n_args: int) -> List[str]:
+    return INLINE_CALL_CODE.fill(return_label=context.next_label('RET'), frame_size=n_args + 5,
+                                 function_name=function_name)
+
+
+def _compact_call_code(context: TranslationContext, function_name: str, n_args: int) -> List[str]:
+    return COMPACT_CALL_CODE.fill(n_args=n_args, function_name=function_name) + \
+        generate_shared_routine_call(context, 'CALL')
+
+
+def generate_call_code(context: TranslationContext, command: Command) -> List[str]:
+    if context.compact:
+        return _compact_call_code(context, command.name, command.index)
+    return _inline_call_code(context, command.name, command.index)
+
+
+FUNCTION_ENTRY_CODE = ('@0', 'A=M')
+ZERO_LOCAL_CODE = ('M=0', 'A=A+1')
+FUNCTION_SET_SP_CODE = ('D=A', '@0', 'M=D')
+
+
+def generate_function_code(context: TranslationContext, command: Command) -> List[str]:
+    context.function_name = command.name
+    n_locals = command.index
+    output = [f'({command.name})']
+    # functions without locals need no set up, otherwise zero each local then move SP past them
+    if n_locals:
+        output.extend(FUNCTION_ENTRY_CODE)
+        output.extend(ZERO_LOCAL_CODE * n_locals)
+        output.extend(FUNCTION_SET_SP_CODE)
+    return output
+
+
+# restores the caller's frame, using R13 for the frame base and R14 for the return address
+RETURN_CODE = CodeTemplate('''
+            @1
+            D=M
+            @13
+            M=D
+            @5
+            A=D-A
             D=M
+            @14
+            M=D
             @0
-            A=M-1
-            A=A-1
-            M=D|M
+            AM=M-1
+            D=M
+            @2
+            A=M
+            M=D
+            @2
+            D=M+1
             @0
-            M=M-1           
-            '''
+            M=D
+            ''' + ''.join(f'''
+            @13
+            AM=M-1
+            D=M
+            @{segment_base}
+            M=D
+            ''' for segment_base in (4, 3, 2, 1)) + '''
+            @14
+            A=M
+            0;JMP
+            ''')
 
-    return code_to_list(code)
+RETURN_JUMP_CODE = CodeTemplate(f'''
+            @{SHARED_ROUTINE_PREFIX}RETURN
+            0;JMP
+            ''')
 
 
-def generate_not_code() -> List[str]:
-    code = '''
-            @0
-            A=M-1
-            M=!M
-           '''
-    return code_to_list(code)
-
-
-def generate_push_code(segment: str, i: str) -> List[str]:
-    i = int(i)
-    if segment in SEGMENT_BASE_MAP:
-        code = f'''
-                @{SEGMENT_BASE_MAP[segment]}
-                D=M
-                @{i}
-                D=D+A
-                A=D
-                D=M
-                @0
-                A=M
-                M=D
-                @0
-                M=M+1
-                '''
-    elif segment == 'constant':
-        code = f'''
-                @{i}
-                D=A
-                @0
-                A=M
-                M=D
-                @0
-                M=M+1                
-                '''
-    elif segment == 'temp':
-        code = f'''
-                @{i}
-                D=A
-                @5
-                A=D+A
-                D=M
-                @0
-                A=M
-                M=D
-                @0
-                M=M+1               
-                '''
-    elif segment == 'static':
-        code = f'''
-                @static.{i}
-                D=M
-                @0
-                A=M
-                M=D
-                @0
-                M=M+1               
-                '''
-    elif segment == 'pointer':
-        code = f'''
-                @{i}
-                D=A
-                @3
-                A=A+D
-                D=M
-                @0
-                A=M
-                M=D
-                @0
-                M=M+1    
-                '''
-    else:
-        raise ValueError(f'{segment} not supported for push')
-
-    return code_to_list(code)
-
-
-def generate_pop_code(segment: str, i: str) -> List[str]:
-    i = int(i)
-    if segment in SEGMENT_BASE_MAP:
-        code = f'''
-                @{SEGMENT_BASE_MAP[segment]}
-                D=M
-                @{i}
-                D=D+A
-                
-                @13
-                M=D
-                
-                @0
-                A=M-1
-                D=M
-
-                @13
-                A=M
-                M=D
-                
-                @0
-                M=M-1
-               '''
-    elif segment == 'temp':
-        code = f'''
-                @5
-                D=A
-                @{i}
-                D=D+A
-
-                @13
-                M=D
-
-                @0
-                A=M-1
-                D=M
-
-                @13
-                A=M
-                M=D
-
-                @0
-                M=M-1
-                '''
-    elif segment == 'static':
-        code = f'''
-                @0
-                A=M-1
-                D=M
-                @static.{i}
-                M=D
-                @0
-                M=M-1
-                '''
-    elif segment == 'pointer':
-        code = f'''
-                @{i}
-                D=A
-                @3
-                D=A+D
-
-                @13
-                M=D
-
-                @0
-                A=M-1
-                D=M
-                
-                @13
-                A=M
-                M=D
-                
-                @0
-                M=M-1                
-                '''
-    else:
-        raise ValueError(f'{segment} not supported for pop')
+def _return_code() -> List[str]:
+    return list(RETURN_CODE.instructions)
 
-    return code_to_list(code)
 
+def generate_return_code(context: TranslationContext, command: Command) -> List[str]:
+    # return is long and the same everywhere, so it always jumps to the shared routine
+    context.shared_routine_calls['RETURN'] += 1
+    return list(RETURN_JUMP_CODE.instructions)
 
-def generate_if_go_to_code(label: str):
-    code = f'''
+
+def generate_bootstrap_code(context: TranslationContext) -> List[str]:
+    code = '''
+            @256
+            D=A
             @0
-            A=M-1
-            D=M
-            @{label}
-            D;JGT
+            M=D
             '''
-    return code_to_list(code)
+    return code_to_list(code) + generate_call_code(context, Command(CALL, name=ENTRY_FUNCTION))
 
 
-def generate_go_to_code(label: str):
-    code = f'''
-            @{label}
-            0
-;JMP
-            '''
-    return code_to_list(code)
+HACK_COMMAND_GENERATORS = {
+    ADD: generate_add_code,
+    SUB: generate_sub_code,
+    AND: generate_and_code,
+    OR: generate_or_code,
+    NEG: generate_neg_code,
+    NOT: generate_not_code,
+    GT: generate_gt_code,
+    LT: generate_lt_code,
+    EQ: generate_eq_code,
+    PUSH: generate_push_code,
+    POP: generate_pop_code,
+    IF_GOTO: generate_if_go_to_code,
+    GOTO: generate_go_to_code,
+    LABEL: generate_label_code,
+    CALL: generate_call_code,
+    FUNCTION: generate_function_code,
+    RETURN: generate_return_code,
+}
 
 
-def generate_label_code(label: str):
-    code = f'''
-            ({label})
-            '''
-    return code_to_list(code)
+# Code for the commands CommandOptimiser rewrites sequences into. They only appear after optimisation, never in .vm
+# files, and work on memory directly instead of going through the stack.
 
+# segments whose address is fixed, relative to their base
+DIRECT_SEGMENT_BASE_MAP = {
+    TEMP: 5,
+    POINTER: 3,
+}
 
-def generate_call_code():
-    pass
+# the furthest entry of a based segment reached with A=A+1 rather than by adding the index through D
+UNROLLED_INDEX_LIMIT = 3
 
+BINARY_OPERATIONS = (ADD, SUB, AND, OR)
+UNARY_OPERATIONS = (NEG, NOT)
 
-def generate_function_code():
-    pass
+# x = x op y with x in M and y in D
+MEMORY_OPERATION_COMP = {
+    ADD: 'D+M',
+    SUB: 'M-D',
+    AND: 'D&M',
+    OR: 'D|M',
+}
 
+# D = D op y with y in M or, with A in place of M, a constant in A
+D_OPERATION_COMP = {
+    ADD: 'D+M',
+    SUB: 'D-M',
+    AND: 'D&M',
+    OR: 'D|M',
+    NEG: '-D',
+    NOT: '!D',
+}
 
-def generate_return_code():
-    pass
+# M op constant that the ALU does without loading the constant, None when M is unchanged
+ALU_CONSTANT_OPERATIONS = {
+    (ADD, 0): None,
+    (SUB, 0): None,
+    (AND, -1): None,
+    (OR, 0): None,
+    (ADD, 1): 'M=M+1',
+    (ADD, -1): 'M=M-1',
+    (SUB, 1): 'M=M-1',
+    (SUB, -1): 'M=M+1',
+    (AND, 0): 'M=0',
+    (OR, -1): 'M=-1',
+}
 
+# D op constant without loading the constant, None when D is unchanged
+D_CONSTANT_OPERATIONS = {
+    (ADD, 0): None,
+    (SUB, 0): None,
+    (AND, -1): None,
+    (OR, 0): None,
+    (ADD, 1): 'D=D+1',
+    (ADD, -1): 'D=D-1',
+    (SUB, 1): 'D=D-1',
+    (SUB, -1): 'D=D+1',
+    (AND, 0): 'D=0',
+    (OR, -1): 'D=-1',
+}
 
-HACK_COMMAND_GENERATORS = {
-    'add': generate_add_code,
-    'sub': generate_sub_code,
-    'and': generate_and_code,
-    'or': generate_or_code,
-    'neg': generate_neg_code,
-    'not': generate_not_code,
-    'gt': generate_gt_code,
-    'lt': generate_lt_code,
-    'eq': generate_eq_code,
-    'push': generate_push_code,
-    'pop': generate_pop_code,
-    'if-goto': generate_if_go_to_code,
-    'goto': generate_go_to_code,
-    'label': generate_label_code,
-    'call': generate_call_code,
-    'function': generate_function_code,
-    'return': generate_return_code,
+ALU_CONSTANTS = (0, 1, -1)
+
+
+def _load_constant_code(value: int) -> List[str]:
+    if value in ALU_CONSTANTS:
+        return [f'D={value}']
+    if value >= 0:
+        return [f'@{value}', 'D=A']
+    # A only takes positive constants, and !A gives -A-1
+    return [f'@{-value - 1}', 'D=!A']
+
+
+def _location_code(context: TranslationContext, segment: int, i: int) -> Tuple[List[str], List[str]]:
+    '''
+    Code that points A at segment i, as set up code that may use D and R13, and code that then sets A without D.
+    '''
+    if segment == STATIC:
+        return [], [f'@{context.static_symbol(i)}']
+    if segment in DIRECT_SEGMENT_BASE_MAP:
+        return [], [f'@{DIRECT_SEGMENT_BASE_MAP[segment] + i}']
+    if segment not in SEGMENT_BASE_MAP:
+        raise ValueError(f'{SEGMENT_NAMES[segment]} is not a memory segment')
+    base = SEGMENT_BASE_MAP[segment]
+    if i == 0:
+        return [], [f'@{base}', 'A=M']
+    if i <= UNROLLED_INDEX_LIMIT:
+        return [], [f'@{base}', 'A=M+1'] + ['A=A+1'] * (i - 1)
+    return [f'@{base}', 'D=M', f'@{i}', 'D=D+A', '@13', 'M=D'], ['@13', 'A=M']
+
+
+def _load_code(context: TranslationContext, segment: int, i: int) -> List[str]:
+    if segment == CONSTANT:
+        return _load_constant_code(i)
+    if segment in SEGMENT_BASE_MAP and i > UNROLLED_INDEX_LIMIT:
+        return [f'@{SEGMENT_BASE_MAP[segment]}', 'D=M', f'@{i}', 'A=D+A', 'D=M']
+    set_up, address = _location_code(context, segment, i)
+    return set_up + address + ['D=M']
+
+
+def _store_code(context: TranslationContext, segment: int, i: int) -> List[str]:
+    # stores D, keeping it in R14 while the address is worked out if that needs D
+    set_up, address = _location_code(context, segment, i)
+    if not set_up:
+        return address + ['M=D']
+    return ['@14', 'M=D'] + set_up + ['@14', 'D=M'] + address + ['M=D']
+
+
+def _update_code(set_up: List[str], address: List[str], operation: int, value: int) -> List[str]:
+    if (operation, value) in ALU_CONSTANT_OPERATIONS:
+        comp = ALU_CONSTANT_OPERATIONS[operation, value]
+        return [] if comp is None else set_up + address + [comp]
+    return set_up + _load_constant_code(value) + address + [f'M={MEMORY_OPERATION_COMP[operation]}']
+
+
+def generate_push_constant_code(context: TranslationContext, command: Command) -> List[str]:
+    '''
+    Pushes any 16 bit value, writing 0, 1 and -1 straight from the ALU.
+    '''
+    value = command.index
+    if value in ALU_CONSTANTS:
+        return ['@0', 'AM=M+1', 'A=A-1', f'M={value}']
+    code = _load_constant_code(value)
+    code.extend(PUSH_D_INSTRUCTIONS)
+    return code
+
+
+def generate_update_top_code(context: TranslationContext, command: Command) -> List[str]:
+    '''
+    push constant index followed by the binary operation in operands, applied to the top of the stack in place.
+    '''
+    operation, = command.operands
+    return _update_code([], ['@0', 'A=M-1'], operation, command.index)
+
+
+def generate_update_code(context: TranslationContext, command: Command) -> List[str]:
+    '''
+    push segment index, push constant value, operation, pop segment index, applied in place. operands holds the
+    operation and value.
+    '''
+    operation, value = command.operands
+    set_up, address = _location_code(context, command.segment, command.index)
+    return _update_code(set_up, address, operation, value)
+
+
+def generate_move_code(context: TranslationContext, command: Command) -> List[str]:
+    '''
+    push segment index, pop the segment and index in operands, through D.
+    '''
+    to_segment, to_i = command.operands
+    return _load_code(context, command.segment, command.index) + _store_code(context, to_segment, to_i)
+
+
+def generate_compute_code(context: TranslationContext, command: Command) -> List[str]:
+    '''
+    push segment index, optionally a push of a second operand, a unary or binary operation and a pop of the result,
+    computed in D with the second operand kept in R15. operands holds the operation, the segment and index popped to
+    and the segment and index of any second operand.
+    '''
+    operation, to_segment, to_i, *operand = command.operands
+    segment, i = command.segment, command.index
+    code = []
+    if operand:
+        operand_segment, operand_i = operand
+        if operand_segment == CONSTANT and (operation, operand_i) in D_CONSTANT_OPERATIONS:
+            comp = D_CONSTANT_OPERATIONS[operation, operand_i]
+            code += _load_code(context, segment, i) + ([] if comp is None else [comp])
+        elif operand_segment == CONSTANT and 0 <= operand_i <= 32767:
+            # the ALU takes a constant operand straight from A
+            code += _load_code(context, segment, i) + [f'@{operand_i}',
+                                                       f'D={D_OPERATION_COMP[operation].replace("M", "A")}']
+        else:
+            code += _load_code(context, operand_segment, operand_i) + ['@15', 'M=D']
+            code += _load_code(context, segment, i) + ['@15', f'D={D_OPERATION_COMP[operation]}']
+    else:
+        code += _load_code(context, segment, i) + [f'D={D_OPERATION_COMP[operation]}']
+    return code + _store_code(context, to_segment, to_i)
+
+
+FUSED_COMMAND_GENERATORS = {
+    PUSH_CONSTANT: generate_push_constant_code,
+    UPDATE_TOP: generate_update_top_code,
+    UPDATE: generate_update_code,
+    MOVE: generate_move_code,
+    COMPUTE: generate_compute_code,
 }
 
+# indexed by opcode
+COMMAND_GENERATORS = tuple({**HACK_COMMAND_GENERATORS, **FUSED_COMMAND_GENERATORS}[opcode]
+                           for opcode in range(len(OPCODE_NAMES)))
 
-def main():
-    input_path = \
-        '/Users/kamsandhu/Documents/Code/prjoects_non_git/nand2tetris/projects/08/ProgramFlow/BasicLoop'
 
+def _generate_shared_comparison_routine(kind: str) -> List[str]:
+    routine_label = f'{SHARED_ROUTINE_PREFIX}{kind}'
+    code = f'''
+            ({routine_label})
+            @13
+            M=D
+            '''
+    return_code = '''
+            @13
+            A=M
+            0;JMP
+            '''
+    body = _comparison_code(f'{routine_label}.TRUE', COMPARISON_JUMPS[kind])
+    return code_to_list(code) + body + code_to_list(return_code)
 
 
-    if os.path.isdir(input_path):
-        files_to_translate = [os.path.join(input_path, file) for file in os.listdir(input_path) if file.endswith('.vm')]
-    elif os.path.isfile(input_path) and input_path.endswith('.vm'):
-        files_to_translate = [input_path]
+def generate_shared_routines(routines: Iterable[str]) -> List[str]:
+    '''
+    The shared routines, placed after an infinite loop that ends the program so they are only entered when called.
+    '''
+    code = f'''
+            ({SHARED_ROUTINE_PREFIX}END)
+            @{SHARED_ROUTINE_PREFIX}END
+            0;JMP
+            '''
+    output = code_to_list(code)
+    for routine in sorted(routines):
+        output.extend(SHARED_ROUTINE_GENERATORS[routine]())
+    return output
 
-    output_lines = []
 
-    # add sys.init to output lines
+def count_instructions(lines: Iterable[str]) -> int:
+    return sum(1 for line in lines if not line.startswith(('//', '(')))
 
-    for file in files_to_translate:
 
-        with open(file, 'r') as f:
-            lines = f.readlines()
+def _generate_shared_call_routine() -> List[str]:
+    '''
+    Takes the return address in D, the number of arguments in R14 and the address of the function in R15.
+    '''
+    code = f'''
+            ({SHARED_ROUTINE_PREFIX}CALL)
+            '''
+    set_segments_code = '''
+            @0
+            D=M
+            @14
+            D=D-M
+            @5
+            D=D-A
+            @2
+            M=D
+            @0
+            D=M
+            @1
+            M=D
+            @15
+            A=M
+            0;JMP
+            '''
+    return [*code_to_list(code), *PUSH_D_INSTRUCTIONS, *SAVE_FRAME_INSTRUCTIONS, *code_to_list(set_segments_code)]
+
+
+SHARED_ROUTINE_GENERATORS = {
+    'EQ': lambda: _generate_shared_comparison_routine('EQ'),
+    'GT': lambda: _generate_shared_comparison_routine('GT'),
+    'LT': lambda: _generate_shared_comparison_routine('LT'),
+    'CALL': _generate_shared_call_routine,
+    'RETURN': lambda: [f'({SHARED_ROUTINE_PREFIX}RETURN)'] + _return_code(),
+}
 
-        # add something to maerk new file in vm code
 
+def _routine_code_sizes(routine: str) -> Tuple[int, int, int]:
+    '''
+    Instruction counts of a routine expanded inline, of a call to the shared routine and of the shared routine itself.
+    '''
+    context = TranslationContext('', compact=True)
+    if routine in COMPARISON_JUMPS:
+        inline_code = _comparison_code(context.next_label(routine), COMPARISON_JUMPS[routine])
+        call_code = generate_shared_routine_call(context, routine)
+    elif routine == 'CALL':
+        inline_code = _inline_call_code(context, 'f', 0)
+        call_code = _compact_call_code(context, 'f', 0)
+    else:
+        inline_code = _return_code()
+        call_code = generate_return_code(context, Command(RETURN))
+    routine_code = SHARED_ROUTINE_GENERATORS[routine]()
+    return count_instructions(inline_code), count_instructions(call_code), count_instructions(routine_code)
+
+
+def shared_routine_report(routine_calls: Dict[str, int]) -> str:
+    '''
+    ROM saved by each shared routine against the extra cycles spent calling it instead of running it inline, and the
+    instructions executed per function call and return.
+    '''
+    lines = []
+    total_saved = -count_instructions(generate_shared_routines([]))
+    for routine, n_calls in sorted(routine_calls.items()):
+        inline_size, call_size, routine_size = _routine_code_sizes(routine)
+        extra_cycles = call_size + routine_size - inline_size
+        saved = n_calls * (inline_size - call_size) - routine_size
+        total_saved += saved
+        lines.append(f'{routine.lower()}: {n_calls} calls, saves {saved} instructions of ROM, '
+                     f'costs {extra_cycles} extra cycles per call')
+    lines.append(f'shared routines saved {total_saved} instructions of ROM in total')
+
+    if 'RETURN' in routine_calls:
+        _, return_size, return_routine_size = _routine_code_sizes('RETURN')
+        for compact in (False, True):
+            call_code = generate_call_code(TranslationContext('', compact=compact), Command(CALL, name='f'))
+            call_size = count_instructions(call_code)
+            call_cycles = call_size + (_routine_code_sizes('CALL')[2] if compact else 0)
+            lines.append(f'{"compact" if compact else "inline"} call: {call_size} instructions per call site, '
+                         f'{call_cycles + return_size + return_routine_size} cycles per call and return')
+    return '\n'.join(lines)
+
+
+SP_ALIASES = ('0', 'SP', 'R0')
+
+
+def _split_c_instruct(instruction: str) -> Tuple[str, str, str]:
+    dest, _, rest = instruction.rpartition('=')
+    comp, _, jump = rest.partition(';')
+    return dest, comp, jump
+
+
+class PeepholeOptimiser:
+    '''
+    Removes redundant instructions from generated Hack assembly, one basic block at a time (a block ends at a label or
+    a jump). Every rewrite only deletes instructions:
+
+    - reloads of a value A already holds, e.g. the @0 after an SP decrement, or @0 A=M-1 right after A=M-1
+    - reading back a value that was just pushed from D, i.e. push followed by @0 A=M-1 D=M
+    - an SP increment and decrement with nothing between them that touches the stack
+    - storing D above the top of the stack once that increment is gone
+
+    instructions counts the instructions seen so far and removed those deleted.
+    '''
+
+    PUSH_D = ['@0', 'A=M', 'M=D']
+    INCREMENT_SP = ['@0', 'M=M+1']
+    DECREMENT_SP = ['@0', 'M=M-1']
+    READ_TOP = ['@0', 'A=M-1', 'D=M']
+    # instructions after a run that a rule looks at
+    LOOKAHEAD = 2
+
+    def __init__(self) -> None:
+        self.instructions = 0
+        self.removed = 0
+
+    def optimise(self, lines: Iterable[str]) -> Iterator[str]:
+        block = []
         for line in lines:
-            if line.startswith('//') or not line or line.isspace():
+            if line.startswith('('):
+                yield from self._optimise_block(block)
+                block = []
+                yield line
+            else:
+                block.append(line)
+                if ';' in line and not line.startswith('//'):
+                    yield from self._optimise_block(block)
+                    block = []
+        yield from self._optimise_block(block)
+
+    def _optimise_block(self, block: List[str]) -> List[str]:
+        code = [i for i, line in enumerate(block) if not line.startswith('//')]
+        # removing a reload can break up a run another rule removes whole, so reloads are only removed once those runs
+        # are gone
+        live = self._apply_rules(block, code, reloads=False)
+        live = self._apply_rules(block, live, reloads=True)
+
+        self.instructions += len(code)
+        self.removed += len(code) - len(live)
+        kept = set(live)
+        return [line for i, line in enumerate(block) if i in kept or line.startswith('//')]
+
+    def _apply_rules(self, block: List[str], code: List[int], reloads: bool) -> List[int]:
+        '''
+        The indexes in code of the instructions of block the rules leave, in a single pass that moves them from pending
+        onto live one at a time. Rules are only tried on runs ending at the top of live, with the instructions still
+        pending as lookahead, and the last instruction of a run tells which rule can remove it. A deletion moves the
+        live instructions from just before it back to pending, so the runs it changed are tried again. As each
+        instruction is moved back a bounded number of times the pass is linear in the length of the block.
+        '''
+        rules = {
+            self.READ_TOP[-1]: self._pushed_value_read_back,
+            self.DECREMENT_SP[-1]: self._cancelled_sp_adjustment,
+            self.PUSH_D[-1]: self._dead_push_store,
+        }
+        if reloads:
+            rules.update({'A=M': self._redundant_loads, 'A=M-1': self._redundant_loads})
+        pending = code[::-1]
+        instructions: List[str] = []
+        live: List[int] = []
+        while True:
+            if instructions:
+                tail = instructions[-1]
+                rule = self._redundant_loads if reloads and tail.startswith('@') else rules.get(tail)
+                if rule is not None:
+                    removed = rule(instructions, [block[i] for i in pending[:-self.LOOKAHEAD - 1:-1]])
+                    if removed:
+                        # runs ending up to LOOKAHEAD instructions before the first deletion had it as their lookahead
+                        resume = max(0, removed[0] - self.LOOKAHEAD)
+                        pending.extend(reversed([index for i, index in enumerate(live[resume:], resume)
+                                                 if i not in removed]))
+                        del instructions[resume:], live[resume:]
+                        continue
+            if not pending:
+                return live
+            index = pending.pop()
+            instructions.append(block[index])
+            live.append(index)
+
+    @staticmethod
+    def _a_is_reloaded(lookahead: List[str]) -> bool:
+        # A is not relied on after the run, the next instruction sets it or the block ends
+        return not lookahead or lookahead[0].startswith('@')
+
+    @staticmethod
+    def _a_value(instructions: List[str], end: int) -> Optional[Tuple[str, object]]:
+        # what A is known to hold after instructions[:end], the address symbol or the stack pointer plus offset, which
+        # only depends on the instructions from the last A-instruction
+        start = end - 1
+        while start >= 0 and not instructions[start].startswith('@'):
+            start -= 1
+        if start < 0:
+            return None
+        symbol = instructions[start][1:]
+        a_value = ('@', '0' if symbol in SP_ALIASES else symbol)
+        for instruction in instructions[start + 1:end]:
+            dest, comp, _ = _split_c_instruct(instruction)
+            if 'A' not in dest:
+                continue
+            if a_value == ('@', '0') and 'M' not in dest and comp in ('M', 'M-1'):
+                a_value = ('SP', -1 if comp == 'M-1' else 0)
+            elif a_value is not None and a_value[0] == 'SP' and 'M' not in dest and comp in ('A-1', 'A+1'):
+                a_value = ('SP', a_value[1] + (-1 if comp == 'A-1' else 1))
+            else:
+                a_value = None
+        return a_value
+
+    def _redundant_loads(self, instructions: List[str], lookahead: List[str]) -> List[int]:
+        # reloads of the address or stack pointer offset A already holds
+        end = len(instructions)
+        if end and instructions[-1].startswith('@'):
+            symbol = instructions[-1][1:]
+            if self._a_value(instructions, end - 1) == ('@', '0' if symbol in SP_ALIASES else symbol):
+                return [end - 1]
+        if end >= 2 and instructions[-1] in ('A=M', 'A=M-1') and instructions[-2][1:] in SP_ALIASES \
+                and instructions[-2].startswith('@'):
+            offset = -1 if instructions[-1] == 'A=M-1' else 0
+            if self._a_value(instructions, end - 2) == ('SP', offset):
+                return [end - 2, end - 1]
+        return []
+
+    def _pushed_value_read_back(self, instructions: List[str], lookahead: List[str]) -> List[int]:
+        window = self.PUSH_D + self.INCREMENT_SP + self.READ_TOP
+        end = len(instructions)
+        if instructions[-len(window):] == window and self._a_is_reloaded(lookahead):
+            return list(range(end - len(self.READ_TOP), end))
+        return []
+
+    def _cancelled_sp_adjustment(self, instructions: List[str], lookahead: List[str]) -> List[int]:
+        end = len(instructions)
+        if instructions[-2:] != self.DECREMENT_SP or not self._a_is_reloaded(lookahead):
+            return []
+        # the increment is the first access to the stack pointer before the decrement
+        i = end - 3
+        while i >= 0 and not (instructions[i].startswith('@') and instructions[i][1:] in SP_ALIASES):
+            i -= 1
+        if i < 0 or instructions[i:i + 2] != self.INCREMENT_SP:
+            return []
+        # A must be loaded from a constant or symbol before any memory access in between
+        a_is_symbol = False
+        for instruction in instructions[i + 2:end - 2]:
+            if instruction.startswith('@'):
+                a_is_symbol = True
                 continue
+            dest, comp, jump = _split_c_instruct(instruction)
+            if jump or (('M' in dest or 'M' in comp) and not a_is_symbol):
+                return []
+            if 'A' in dest:
+                a_is_symbol = False
+        return [i, i + 1, end - 2, end - 1]
+
+    def _dead_push_store(self, instructions: List[str], lookahead: List[str]) -> List[int]:
+        # once the SP increment after a push has been cancelled out, the value stored above the stack is never read
+        end = len(instructions)
+        if instructions[-len(self.PUSH_D):] == self.PUSH_D and lookahead != self.INCREMENT_SP \
+                and self._a_is_reloaded(lookahead):
+            return list(range(end - len(self.PUSH_D), end))
+        return []
+
+
+COMPARISON_OPERATIONS = {
+    EQ: lambda x, y: x == y,
+    GT: lambda x, y: x > y,
+    LT: lambda x, y: x < y,
+}
+
+FOLDED_BINARY_OPERATIONS = {
+    ADD: lambda x, y: x + y,
+    SUB: lambda x, y: x - y,
+    AND: lambda x, y: x & y,
+    OR: lambda x, y: x | y,
+    # compared on x - y wrapped to a word, as the generated code does
+    **{opcode: (lambda compare: lambda x, y: -1 if compare(to_word(x - y), 0) else 0)(compare)
+       for opcode, compare in COMPARISON_OPERATIONS.items()},
+}
+
+FOLDED_UNARY_OPERATIONS = {
+    NEG: lambda x: -x,
+    NOT: lambda x: ~x,
+}
+
 
-            output_lines.append(f'// {line[:-1]}')
+def to_word(value: int) -> int:
+    '''
+    value wrapped to a signed 16 bit word, as the Hack ALU would leave it.
+    '''
+    return (value + 0x8000) % 0x10000 - 0x8000
+
+
+class CommandOptimiser:
+    '''
+    Rewrites the commands of one file before code generation, looking at most WINDOW commands ahead:
+
+    - pushes of constants followed by an operation on them are folded into a push of the result
+    - push x, pop y is moved through D, and push x, push y, operation, pop z or push x, operation, pop y is computed
+      in D, without touching the stack
+    - push x, push constant c, operation, pop x updates x in place, and push constant c, operation updates the top of
+      the stack in place
+    - 0, 1 and -1 are pushed straight from the ALU
+
+    The rewritten commands are the ones in FUSED_COMMAND_GENERATORS. The instructions saved against translating each
+    command on its own are added to the context's instructions_eliminated.
+    '''
+
+    WINDOW = 4
+
+    def __init__(self, context: TranslationContext) -> None:
+        self.context = context
+
+    def optimise(self, commands: Iterable[Command]) -> Iterator[Command]:
+        # each pending command keeps the commands it was made from
+        pending: List[Tuple[Command, List[Command]]] = []
+        for command in commands:
+            pending.append((command, [command]))
+            self._fold(pending)
+            while len(pending) >= self.WINDOW:
+                yield self._rewrite(pending)
+        while pending:
+            yield self._rewrite(pending)
+
+    @staticmethod
+    def _constant(command: Command) -> Optional[int]:
+        if command.opcode == PUSH_CONSTANT or (command.opcode == PUSH
+                                                      and command.segment == CONSTANT):
+            return command.index
+        return None
+
+    @staticmethod
+    def _pushed(command: Command) -> Optional[Tuple[int, int]]:
+        if command.opcode == PUSH_CONSTANT:
+            return CONSTANT, command.index
+        return (command.segment, command.index) if command.opcode == PUSH else None
+
+    @staticmethod
+    def _popped(command: Command) -> Optional[Tuple[int, int]]:
+        if command.opcode == POP and command.segment != CONSTANT:
+            return command.segment, command.index
+        return None
+
+    def _fold(self, pending: List[Tuple[Command, List[Command]]]) -> None:
+        while True:
+            if len(pending) >= 2 and pending[-1][0].opcode in FOLDED_UNARY_OPERATIONS:
+                x = self._constant(pending[-2][0])
+                if x is not None:
+                    value = FOLDED_UNARY_OPERATIONS[pending[-1][0].opcode](x)
+                    pending[-2:] = [(Command(PUSH_CONSTANT, index=to_word(value)),
+                                     pending[-2][1] + pending[-1][1])]
+                    continue
+            if len(pending) >= 3 and pending[-1][0].opcode in FOLDED_BINARY_OPERATIONS:
+                x, y = self._constant(pending[-3][0]), self._constant(pending[-2][0])
+                if x is not None and y is not None:
+                    value = FOLDED_BINARY_OPERATIONS[pending[-1][0].opcode](x, y)
+                    originals = pending[-3][1] + pending[-2][1] + pending[-1][1]
+                    pending[-3:] = [(Command(PUSH_CONSTANT, index=to_word(value)), originals)]
+                    continue
+            return
+
+    def _fuse(self, pending: List[Tuple[Command, List[Command]]]) -> Tuple[Optional[Command], int]:
+        '''
+        The command the first pending commands can be rewritten to and how many of them it replaces.
+        '''
+        commands = [command for command, _ in pending[:self.WINDOW]]
+        pushed = self._pushed(commands[0])
+        if pushed is None:
+            return None, 1
+
+        if len(commands) >= 4 and commands[2].opcode in BINARY_OPERATIONS:
+            operation = commands[2].opcode
+            operand, popped = self._pushed(commands[1]), self._popped(commands[3])
+            if operand is not None and popped is not None:
+                if pushed == popped and operand[0] == CONSTANT:
+                    return Command(UPDATE, *pushed, operands=(operation, operand[1])), 4
+                return Command(COMPUTE, *pushed, operands=(operation, *popped, *operand)), 4
+        if len(commands) >= 3 and commands[1].opcode in UNARY_OPERATIONS:
+            popped = self._popped(commands[2])
+            if popped is not None:
+                return Command(COMPUTE, *pushed, operands=(commands[1].opcode, *popped)), 3
+        if len(commands) >= 2:
+            popped = self._popped(commands[1])
+            if popped is not None:
+                return Command(MOVE, *pushed, operands=popped), 2
+            if pushed[0] == CONSTANT and commands[1].opcode in BINARY_OPERATIONS:
+                return Command(UPDATE_TOP, index=pushed[1], operands=(commands[1].opcode,)), 2
+        if pushed[0] == CONSTANT and (commands[0].opcode == PUSH_CONSTANT
+                                              or pushed[1] in ALU_CONSTANTS):
+            return Command(PUSH_CONSTANT, index=pushed[1]), 1
+        return None, 1
+
+    def _rewrite(self, pending: List[Tuple[Command, List[Command]]]) -> Command:
+        fused, n_commands = self._fuse(pending)
+        originals = [command for _, commands in pending[:n_commands] for command in commands]
+        del pending[:n_commands]
+        if fused is None:
+            return originals[0]
+
+        # measure both translations in a context of their own, so the file's labels and statics are untouched
+        context = TranslationContext(self.context.file_name, self.context.compact, self.context.static_addresses)
+        before = count_instructions(translate_commands(context, originals, comments=False))
+        after = count_instructions(COMMAND_GENERATORS[fused.opcode](context, fused))
+        self.context.instructions_eliminated += before - after
+        return fused._replace(line='; '.join(command.line for command in originals))
+
+
+def command_optimiser_report(contexts: Iterable[TranslationContext]) -> str:
+    lines = []
+    total = 0
+    for context in contexts:
+        total += context.instructions_eliminated
+        lines.append(f'{context.file_name}: command optimiser eliminated {context.instructions_eliminated} '
+                     f'instructions')
+    lines.append(f'command optimiser eliminated {total} instructions in total')
+    return '\n'.join(lines)
+
+
+def list_vm_files(input_path: str) -> List[str]:
+    if os.path.isdir(input_path):
+        return [os.path.join(input_path, file) for file in sorted(os.listdir(input_path)) if file.endswith('.vm')]
+    elif os.path.isfile(input_path) and input_path.endswith('.vm'):
+        return [input_path]
+    raise ValueError(f'{input_path} is not a .vm file or a directory')
+
+
+def read_commands(lines: Iterable[str]) -> Iterator[Command]:
+    '''
+    Parses lines in a single pass, yielding each command and skipping blank lines and comments. Words may be separated
+    by any mix of spaces and tabs, lines may end in CRLF and a comment may follow a command. Each command's line is its
+    words joined by single spaces, and errors give the line number.
+    '''
+    for line_number, line in enumerate(lines, 1):
+        words = tokenise_command(line)
+        if not words:
+            continue
+        try:
+            yield _parse_words(words)
+        except ValueError as e:
+            raise ValueError(f'line {line_number}: {e}') from None
+
+
+def live_commands(commands: Iterable[Command], live_functions: Optional[Set[str]] = None) -> Iterator[Command]:
+    '''
+    Drops the commands of functions not in live_functions, code outside a function is always kept.
+    '''
+    if live_functions is None:
+        yield from commands
+        return
+    live = True
+    for command in commands:
+        if command.opcode == FUNCTION:
+            live = command.name in live_functions
+        if live:
+            yield command
+
+
+def read_file_commands(path: str, live_functions: Optional[Set[str]] = None) -> Iterator[Command]:
+    with open(path, 'r') as f:
+        try:
+            yield from live_commands(read_commands(f), live_functions)
+        except ValueError as e:
+            raise ValueError(f'{path}: {e}') from None
+
+
+def translate_commands(context: TranslationContext, commands: Iterable[Command],
+                       comments: bool = True) -> Iterator[str]:
+    '''
+    Yields the assembly for commands, each preceded by a comment of its line when comments is set.
+    '''
+    generators = COMMAND_GENERATORS
+    if not comments:
+        for command in commands:
+            yield from generators[command.opcode](context, command)
+        return
+    for command in commands:
+        yield f'// {command.line}'
+        yield from generators[command.opcode](context, command)
+
+
+def _file_name(path: str) -> str:
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def allocate_statics(paths: List[str], live_functions: Optional[Set[str]] = None) -> Dict[str, Dict[int, int]]:
+    '''
+    Packs the statics used by the .vm files at paths into consecutive RAM addresses from STATIC_BASE_ADDRESS, in the
+    order of paths then of index. Indexes a file never uses, or only uses outside live_functions, get no address.
+    Returns the address of each index per file.
+    '''
+    addresses = {}
+    next_address = STATIC_BASE_ADDRESS
+    for path in paths:
+        indexes = {command.index for command in read_file_commands(path, live_functions)
+                   if command.segment == STATIC}
+        file_addresses = addresses[_file_name(path)] = {}
+        for i in sorted(indexes):
+            file_addresses[i] = next_address
+            next_address += 1
+
+    if next_address - 1 > STATIC_END_ADDRESS:
+        raise ValueError(f'statics need {next_address - STATIC_BASE_ADDRESS} words of RAM, more than the '
+                         f'{STATIC_END_ADDRESS - STATIC_BASE_ADDRESS + 1} between {STATIC_BASE_ADDRESS} and '
+                         f'{STATIC_END_ADDRESS}')
+    return addresses
+
+
+def build_call_graph(paths: List[str]) -> Dict[Optional[str], Set[str]]:
+    '''
+    The functions called by each function defined in the .vm files at paths, calls made outside any function are
+    listed under None.
+    '''
+    graph = {None: set()}
+    for path in paths:
+        callees = graph[None]
+        for command in read_file_commands(path):
+            if command.opcode == FUNCTION:
+                callees = graph.setdefault(command.name, set())
+            elif command.opcode == CALL:
+                callees.add(command.name)
+    return graph
+
+
+def reachable_functions(graph: Dict[Optional[str], Set[str]]) -> Set[str]:
+    '''
+    The functions that can be called starting from ENTRY_FUNCTION and code outside any function. Every function is
+    reachable in programs without ENTRY_FUNCTION, since they have no single entry point.
+    '''
+    if ENTRY_FUNCTION not in graph:
+        return {function for function in graph if function is not None}
+    reachable = set()
+    to_visit = [ENTRY_FUNCTION, *graph[None]]
+    while to_visit:
+        function = to_visit.pop()
+        if function in reachable:
+            continue
+        reachable.add(function)
+        to_visit.extend(graph.get(function, ()))
+    return reachable
+
+
+def dead_function_report(paths: List[str], graph: Dict[Optional[str], Set[str]], live_functions: Set[str],
+                         compact: bool = False) -> str:
+    '''
+    Functions eliminated and the ROM they would have taken, measured by translating them on their own.
+    '''
+    dead_functions = {function for function in graph if function is not None} - live_functions
+    saved = 0
+    for path in paths:
+        function = None
+        dead_commands = []
+        for command in read_file_commands(path):
+            if command.opcode == FUNCTION:
+                function = command.name
+            if function in dead_functions:
+                dead_commands.append(command)
+        context = TranslationContext(_file_name(path), compact)
+        saved += count_instructions(translate_commands(context, dead_commands, comments=False))
+    return f'eliminated {len(dead_functions)} of {len(graph) - 1} functions, saving {saved} instructions of ROM'
+
+
+def static_report(statics_used: Dict[str, Iterable[int]],
+                  static_addresses: Optional[Dict[str, Dict[int, int]]] = None) -> str:
+    '''
+    Static RAM used by each file, with the addresses it was given when statics are packed by the translator.
+    '''
+    lines = []
+    total = 0
+    for file_name, indexes in statics_used.items():
+        indexes = sorted(indexes)
+        if not indexes:
+            continue
+        total += len(indexes)
+        line = f'{file_name}: {len(indexes)} static{"" if len(indexes) == 1 else "s"}'
+        if static_addresses is not None:
+            addresses = [static_addresses[file_name][i] for i in indexes]
+            line += f' at {min(addresses)}-{max(addresses)}'
+        lines.append(line)
+    available = STATIC_END_ADDRESS - STATIC_BASE_ADDRESS + 1
+    lines.append(f'statics use {total} of the {available} words between {STATIC_BASE_ADDRESS} and '
+                 f'{STATIC_END_ADDRESS}{", overflowing into the stack" if total > available else ""}')
+    return '\n'.join(lines)
+
+
+_FUNCTION_PATTERN = re.compile(rb'^[ \t]*function[ \t]+(\S+)', re.MULTILINE)
+
+
+class TranslationCache:
+    '''
+    On disk cache of translated .vm files, keyed by a hash of the source, its file name, the options that change its
+    translation and TRANSLATOR_VERSION. Each entry is the file's assembly plus a json file holding what its context
+    collected. Entries are evicted least recently used first once the cache holds more than max_bytes. Safe to share
+    between processes.
+    '''
+
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_CACHE_BYTES) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(path: str, compact: bool, static_addresses: Optional[Dict[int, int]],
+            live_functions: Optional[Set[str]], optimise: bool, comments: bool) -> str:
+        with open(path, 'rb') as f:
+            source = f.read()
+        # only the live functions the file defines change its translation
+        if live_functions is not None:
+            live_functions = sorted(name.decode() for name in _FUNCTION_PATTERN.findall(source)
+                                    if name.decode() in live_functions)
+        statics = None if static_addresses is None else sorted(static_addresses.items())
+        options = [_file_name(path), compact, statics, live_functions, optimise, comments]
+        digest = hashlib.sha256(f'{TRANSLATOR_VERSION}:{json.dumps(options)}:'.encode())
+        digest.update(source)
+        return digest.hexdigest()
+
+    def _paths(self, key: str) -> Tuple[str, str]:
+        code_path = os.path.join(self.directory, f'{key}.asm')
+        return code_path, f'{code_path}.json'
+
+    def get(self, key: str) -> Optional[Tuple[str, dict]]:
+        '''
+        The cached assembly for key and the json saved with it, or None on a miss.
+        '''
+        code_path, metadata_path = self._paths(key)
+        try:
+            with open(metadata_path, 'r') as f:
+                metadata = json.load(f)
+            with open(code_path, 'r') as f:
+                code = f.read()
+            # mtime records when an entry was last used
+            os.utime(metadata_path)
+        except (OSError, ValueError):
+            return None
+        return code, metadata
+
+    def put(self, key: str, code: str, metadata: dict) -> None:
+        code_path, metadata_path = self._paths(key)
+        suffix = f'.{os.getpid()}.tmp'
+        with open(code_path + suffix, 'w') as f:
+            f.write(code)
+        os.replace(code_path + suffix, code_path)
+        # the metadata is written last, an entry only counts once it exists
+        with open(metadata_path + suffix, 'w') as f:
+            json.dump(metadata, f)
+        os.replace(metadata_path + suffix, metadata_path)
+        self._evict()
+
+    def _evict(self) -> None:
+        entries = []
+        total_bytes = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.json'):
+                continue
+            code_path = entry.path[:-len('.json')]
+            try:
+                size = entry.stat().st_size + os.path.getsize(code_path)
+                entries.append((entry.stat().st_mtime, size, code_path, entry.path))
+            except OSError:
+                continue
+            total_bytes += size
+
+        for _, size, code_path, metadata_path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            for path in (metadata_path, code_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total_bytes -= size
+
+
+def cache_report(contexts: Iterable[TranslationContext]) -> str:
+    lines = []
+    hits = misses = 0
+    for context in contexts:
+        hits += context.cached
+        misses += not context.cached
+        lines.append(f'{context.file_name}: {"hit" if context.cached else "miss"}')
+    lines.append(f'translation cache: {hits} hits, {misses} misses')
+    return '\n'.join(lines)
+
+
+def _file_commands(context: TranslationContext, path: str, live_functions: Optional[Set[str]],
+                   optimise: bool) -> Iterator[Command]:
+    commands = read_file_commands(path, live_functions)
+    return CommandOptimiser(context).optimise(commands) if optimise else commands
+
+
+def translate_file(path: str, compact: bool = False, static_addresses: Optional[Dict[int, int]] = None,
+                   live_functions: Optional[Set[str]] = None, optimise: bool = False,
+                   comments: bool = True, cache: Optional[TranslationCache] = None) -> Tuple[str, TranslationContext]:
+    '''
+    Translates a single .vm file, returning its assembly as one string of lines and the context it was translated in.
+    Labels and statics are namespaced by the file name, so files can be translated independently and in any process,
+    one string is much cheaper to send back from a worker than a list of lines. If a cache is given, unchanged files are
+    taken from it rather than translated.
+    '''
+    context = TranslationContext(_file_name(path), compact, static_addresses)
+    if cache is not None:
+        key = cache.key(path, compact, static_addresses, live_functions, optimise, comments)
+        entry = cache.get(key)
+        if entry is not None:
+            code, metadata = entry
+            context.shared_routine_calls.update(metadata['shared_routine_calls'])
+            context.statics_used.update(metadata['statics_used'])
+            context.instructions_eliminated = metadata['instructions_eliminated']
+            context.cached = True
+            return code, context
+
+    code = '\n'.join(translate_commands(context, _file_commands(context, path, live_functions, optimise), comments))
+    if cache is not None:
+        cache.put(key, code, {'shared_routine_calls': context.shared_routine_calls,
+                              'statics_used': sorted(context.statics_used),
+                              'instructions_eliminated': context.instructions_eliminated})
+    return code, context
+
+
+def translate_files(paths: List[str], compact: bool = False,
+                    shared_routine_calls: Optional[Dict[str, int]] = None,
+                    processes: Optional[int] = 1,
+                    static_addresses: Optional[Dict[str, Dict[int, int]]] = None,
+                    contexts: Optional[List[TranslationContext]] = None,
+                    live_functions: Optional[Set[str]] = None,
+                    optimise: bool = False,
+                    comments: bool = True,
+                    cache: Optional[TranslationCache] = None) -> Iterator[str]:
+    '''
+    Yields the assembly for the program made of the .vm files at paths as each command is translated. Files are read a
+    line at a time, so memory use does not grow with the size or number of files. The calls made to shared routines are
+    added to shared_routine_calls once the program has been translated, and the context of each file to contexts.
+    static_addresses, as returned by allocate_statics, places statics instead of the assembler. Functions not in
+    live_functions are left out. optimise runs each file's commands through a CommandOptimiser, and comments precedes
+    the code of each command with a comment of its line. Files unchanged since they were put in cache are taken from it.
+
+    With processes other than 1 the files are translated across a pool of that many processes (None for one per core)
+    and each file's assembly is yielded whole, in the order of paths, so the output is the same as a serial run.
+    '''
+    routine_calls = Counter()
+    file_contexts = []
+    file_names = [_file_name(path) for path in paths]
+    file_static_addresses = [None if static_addresses is None else static_addresses[file_name]
+                             for file_name in file_names]
+
+    if 'Sys' in file_names:
+        context = TranslationContext('Bootstrap', compact=compact)
+        yield from generate_bootstrap_code(context)
+        routine_calls.update(context.shared_routine_calls)
+
+    if processes != 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            n_files = len(paths)
+            for code, context in executor.map(translate_file, paths, [compact] * n_files, file_static_addresses,
+                                              [live_functions] * n_files, [optimise] * n_files,
+                                              [comments] * n_files, [cache] * n_files):
+                if code:
+                    yield from code.split('\n')
+                routine_calls.update(context.shared_routine_calls)
+                file_contexts.append(context)
+    else:
+        for path, file_name, addresses in zip(paths, file_names, file_static_addresses):
+            if cache is not None:
+                code, context = translate_file(path, compact, addresses, live_functions, optimise, comments, cache)
+                if code:
+                    yield from code.split('\n')
+            else:
+                context = TranslationContext(file_name, compact, addresses)
+                yield from translate_commands(context, _file_commands(context, path, live_functions, optimise),
+                                              comments)
+            routine_calls.update(context.shared_routine_calls)
+            file_contexts.append(context)
+
+    if routine_calls:
+        yield from generate_shared_routines(routine_calls)
+    if shared_routine_calls is not None:
+        shared_routine_calls.update(routine_calls)
+    if contexts is not None:
+        contexts.extend(file_contexts)
+
+
+def write_lines(lines: Iterable[str], out_file: TextIO, chunk_lines: int = WRITE_CHUNK_LINES) -> int:
+    '''
+    Writes lines to out_file joined into chunks of chunk_lines, returns the number of lines written.
+    '''
+    n_lines = 0
+    lines = iter(lines)
+    while True:
+        chunk = list(islice(lines, chunk_lines))
+        if not chunk:
+            break
+        out_file.write('\n'.join(chunk) + '\n')
+        n_lines += len(chunk)
+    return n_lines
 
-            parsed_line = parse_command(line)
-            cmd = parsed_line[0]
-            code_generator_func = HACK_COMMAND_GENERATORS[cmd]
-            output_lines.extend(code_generator_func(*parsed_line[1:]))
 
-    file_name = os.path.basename(input_path)
+def main():
+    parser = argparse.ArgumentParser(description='Translate .vm files into Hack assembly')
+    parser.add_argument('input_path', help='a .vm file, or a directory of .vm files')
+    parser.add_argument('--optimise', action='store_true',
+                        help='fold and fuse VM commands before translating them, then run the peephole optimiser over '
+                             'the generated assembly')
+    parser.add_argument('--compact', action='store_true',
+                        help='call shared routines for comparisons and function calls instead of expanding them '
+                             'inline, '
+                             'trading cycles for ROM')
+    parser.add_argument('--no-comments', action='store_true',
+                        help='leave out the comment of each VM command that precedes its code, shrinking the output')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of processes translating the files of a directory in parallel, 0 for one per core '
+                             '(default: 1, translate serially)')
+    parser.add_argument('--pack-statics', action='store_true',
+                        help=f'give statics consecutive addresses from {STATIC_BASE_ADDRESS} in the translator, in '
+                             f'file order with no gaps, instead of leaving them to the assembler')
+    parser.add_argument('--routine-report', action='store_true',
+                        help='print the ROM saved and cycles spent by each shared routine, also printed with --compact')
+    parser.add_argument('--static-report', action='store_true',
+                        help='print the static RAM used by each file')
+    parser.add_argument('--eliminate-dead-functions', action='store_true',
+                        help=f'leave out functions that cannot be called from {ENTRY_FUNCTION}')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory of a translation cache, unchanged .vm files are served from it instead of '
+                             'translated')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_BYTES // 2 ** 20,
+                        help='size in MiB above which least recently used cache entries are evicted')
+    parser.add_argument('--cache-stats', action='store_true',
+                        help='print whether each file was served from the translation cache')
+    args = parser.parse_args()
+    input_path = args.input_path
+    file_name = os.path.basename(os.path.abspath(input_path))
     file_name_wo_extension = os.path.splitext(file_name)[0]
-    with open(f'{file_name_wo_extension}.asm', 'w') as f:
-        for line in output_lines:
-            f.write(f'{line}\n')
+    out_path = f'{file_name_wo_extension}.asm'
+
+    try:
+        files_to_translate = list_vm_files(input_path)
+        shared_routine_calls = Counter()
+        contexts = []
+        live_functions = None
+        if args.eliminate_dead_functions:
+            call_graph = build_call_graph(files_to_translate)
+            live_functions = reachable_functions(call_graph)
+            print(dead_function_report(files_to_translate, call_graph, live_functions, args.compact))
+        static_addresses = allocate_statics(files_to_translate, live_functions) if args.pack_statics else None
+        cache = TranslationCache(args.cache_dir, args.cache_size * 2 ** 20) if args.cache_dir else None
+        output_lines = translate_files(files_to_translate, args.compact, shared_routine_calls,
+                                      processes=args.jobs or None, static_addresses=static_addresses,
+                                      contexts=contexts, live_functions=live_functions, optimise=args.optimise,
+                                      comments=not args.no_comments, cache=cache)
+
+        if args.optimise:
+            optimiser = PeepholeOptimiser()
+            output_lines = optimiser.optimise(output_lines)
+
+        with open(out_path, 'w') as f:
+            try:
+                write_lines(output_lines, f)
+            except Exception:
+                # lines are written as they are translated, do not leave a truncated program behind
+                f.close()
+                os.remove(out_path)
+                raise
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    if shared_routine_calls and (args.compact or args.routine_report):
+        print(shared_routine_report(shared_routine_calls))
+    if args.static_report:
+        print(static_report({context.file_name: context.statics_used for context in contexts}, static_addresses))
+    if args.cache_stats and cache is not None:
+        print(cache_report(contexts))
+    if args.optimise:
+        print(command_optimiser_report(contexts))
+        print(f'peephole optimiser removed {optimiser.removed} of {optimiser.instructions} instructions')
 
 
 if __name__ == '__main__':
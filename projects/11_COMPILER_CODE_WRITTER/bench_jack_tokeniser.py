@@ -0,0 +1,213 @@
+'''
+Benchmarks for jack_compiler/jack_tokeniser.py over the .jack sources of projects 09 and 12
+
+python bench_jack_tokeniser.py [path/to/file.jack ...]
+'''
+import glob
+import os
+import re
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+from typing import Callable, Generator, List, Tuple
+
+from jack_compiler.constants import Constants
+from jack_compiler.jack_tokeniser import JackTokenizer
+
+PROJECTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SOURCE_GLOBS = [os.path.join(PROJECTS_DIR, project, '**', '*.jack') for project in ('09_JACK', '12_OS')]
+REPEAT = 5
+GENERATED_COPIES = (1, 4, 16, 64)
+MEMORY_COPIES = (4, 16, 64)
+
+
+class LegacyJackTokenizer:
+    '''
+    The original tokenizer, which yields the source a character at a time and builds each token a character at a time.
+    '''
+
+    def __init__(self, path: str) -> None:
+        self._token = None
+        self._token_type = None
+        self.input_char_stream = self._generate_input_char_stream(path)
+        self._current_char = None
+        self._has_more_tokens = True
+        self._iterate_current_char()
+        self.advance()
+
+    @property
+    def has_more_tokens(self) -> bool:
+        return self._has_more_tokens
+
+    @staticmethod
+    def _generate_input_char_stream(path: str) -> Generator[str, None, None]:
+        with open(path, 'r') as f:
+            lines = f.readlines()
+            removed_comments_lines = []
+            for line in lines:
+                code_part = line.split('//')[0]
+                removed_comments_lines.append(code_part)
+
+            removed_comments_code = ' '.join(removed_comments_lines)
+            multi_line_comment_regex = r'(/\*\*)(.|\n)*?(\*/)'
+            removed_multi_line_comment_code = re.sub(multi_line_comment_regex, ' ', removed_comments_code)
+
+        for char in removed_multi_line_comment_code:
+            yield char
+
+    def _iterate_current_char(self):
+        if self.has_more_tokens:
+            self._current_char = next(self.input_char_stream, None)
+            if self._current_char is None:
+                self._has_more_tokens = False
+
+    def advance(self) -> None:
+        if not self.has_more_tokens:
+            return
+
+        while self._current_char and self._current_char.isspace():
+            self._iterate_current_char()
+
+        if self._current_char == '"':
+            string_list = []
+            self._iterate_current_char()
+            while self._current_char != '"':
+                string_list.append(self._current_char)
+                self._iterate_current_char()
+            self._token = ''.join(string_list)
+            self._token_type = Constants.STRINGVAL
+            self._iterate_current_char()
+
+        elif self._current_char in JackTokenizer.SYMBOLS:
+            self._token = self._current_char
+            self._token_type = Constants.SYMBOL
+            self._iterate_current_char()
+
+        elif self._current_char and self._current_char.isdigit():
+            integer_list = []
+            while self._current_char and self._current_char.isdigit():
+                integer_list.append(self._current_char)
+                self._iterate_current_char()
+            self._token = int(''.join(integer_list))
+            self._token_type = Constants.INTVAL
+
+        elif self._current_char and self._current_char.isalpha() or self._current_char == '_':
+            identifier_or_keyword_list = []
+            while self._current_char and self._current_char.isalpha() or self._current_char == '_':
+                identifier_or_keyword_list.append(self._current_char)
+                self._iterate_current_char()
+            self._token = ''.join(identifier_or_keyword_list)
+            if self._token in JackTokenizer.KEYWORDS:
+                self._token_type = Constants.KEYWORD
+            else:
+                self._token_type = Constants.IDENTIFIER
+
+        elif self._current_char is None:
+            return
+
+        else:
+            raise Exception(f'Unable to tokenize {self._current_char}')
+
+
+def source_paths() -> List[str]:
+    return sorted(path for pattern in SOURCE_GLOBS for path in glob.glob(pattern, recursive=True))
+
+
+def count_tokens(tokenizer_class: Callable, paths: List[str]) -> int:
+    '''
+    Tokenizes every file at paths, walking the tokens with advance, and returns how many there were.
+    '''
+    n_tokens = 0
+    for path in paths:
+        tokenizer = tokenizer_class(path)
+        while tokenizer.has_more_tokens:
+            n_tokens += 1
+            tokenizer.advance()
+    return n_tokens
+
+
+def bench_tokenizers(paths: List[str]) -> None:
+    n_bytes = sum(os.path.getsize(path) for path in paths)
+    print(f'tokenizing {len(paths)} files, {n_bytes / 1024:.1f} KiB, best of {REPEAT}')
+    rates = []
+    for name, tokenizer_class in (('before: character stream', LegacyJackTokenizer),
+                                  ('after: master regex', JackTokenizer)):
+        n_tokens = count_tokens(tokenizer_class, paths)
+        best = min(timeit.repeat(lambda: count_tokens(tokenizer_class, paths), number=1, repeat=REPEAT))
+        rates.append(n_tokens / best)
+        print(f'{name:<30} {best * 1000:9.2f} ms {n_tokens:8} tokens {n_tokens / best:14,.0f} tokens/s')
+    print(f'speedup: {rates[-1] / rates[0]:.2f}x')
+
+
+def read_sources(paths: List[str]) -> str:
+    sources = []
+    for path in paths:
+        with open(path, 'r') as f:
+            sources.append(f.read())
+    return ''.join(sources)
+
+
+def memory_overhead(func: Callable[[], object]) -> int:
+    '''
+    Peak memory allocated while running func beyond what its result holds.
+    '''
+    tracemalloc.start()
+    result = func()
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return peak - held
+
+
+def bench_generated(paths: List[str], copies: Tuple[int, ...] = GENERATED_COPIES) -> None:
+    '''
+    Tokenizes single files made of copies of the sources at paths, time per token should not grow with the file size.
+    '''
+    source = read_sources(paths)
+    print(f'tokenizing generated files of {", ".join(str(n) for n in copies)} copies of the sources, best of {REPEAT}')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        generated_path = os.path.join(tmp_dir, 'Generated.jack')
+        for n_copies in copies:
+            with open(generated_path, 'w') as f:
+                f.write(source * n_copies)
+            size = f'{len(source) * n_copies / 2 ** 20:.2f} MiB'
+            for name, tokenizer_class in (('before', LegacyJackTokenizer), ('after', JackTokenizer)):
+                n_tokens = count_tokens(tokenizer_class, [generated_path])
+                best = min(timeit.repeat(lambda: count_tokens(tokenizer_class, [generated_path]), number=1,
+                                         repeat=REPEAT))
+                print(f'{size:>10} {name:<8} {best * 1000:10.2f} ms {n_tokens:9} tokens {n_tokens / best:14,.0f} '
+                      f'tokens/s')
+
+
+def bench_memory(paths: List[str], copies: Tuple[int, ...] = MEMORY_COPIES) -> None:
+    '''
+    Tokenizes generated files read into memory and memory mapped, the overhead of a mapped file should not grow with it.
+    '''
+    source = read_sources(paths)
+    print(f'tokenizing generated files read and memory mapped, best of {REPEAT} '
+          f'(overhead is peak memory beyond the tokens)')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        generated_path = os.path.join(tmp_dir, 'Generated.jack')
+        for n_copies in copies:
+            with open(generated_path, 'w') as f:
+                f.write(source * n_copies)
+            size = f'{len(source) * n_copies / 2 ** 20:.2f} MiB'
+            for name, memory_map in (('read', False), ('mapped', True)):
+                best = min(timeit.repeat(lambda: JackTokenizer(generated_path, memory_map), number=1, repeat=REPEAT))
+                overhead = memory_overhead(lambda: JackTokenizer(generated_path, memory_map))
+                print(f'{size:>10} {name:<8} {best * 1000:10.2f} ms {overhead / 2 ** 20:9.2f} MiB overhead')
+
+
+def main():
+    paths = sys.argv[1:] or source_paths()
+    bench_tokenizers(paths)
+    print()
+    bench_generated(paths)
+    print()
+    bench_memory(paths)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,11 +3,15 @@ import os
 from typing import List
 
 from jack_compiler.constants import Constants
-from jack_compiler.jack_tokeniser import JackTokenizer
+from jack_compiler.jack_tokeniser import JackTokenizer, KEYWORD, SYMBOL, IDENTIFIER, INTVAL, STRINGVAL
 from jack_compiler.symbol_table import SymbolTable, SymbolNotFound
 from jack_compiler.vm_writter import VMWriter
 
 
+BINARY_OPERATORS = frozenset(('+', '-', '*', '/', '&', '|', '<', '>', '='))
+UNARY_OPERATORS = frozenset(('-', '~'))
+
+
 def _set_current_grammar_element(grammar_element: str):
     def wrap(func):
         def wrapped_f(*args, **kwargs):
@@ -29,6 +33,7 @@ class CompilationEngine:
 
     def __init__(self, input_path: str, output_path: str) -> None:
 
+        self._input_path = input_path
         self._tokenizer = JackTokenizer(input_path)
         self._vm_writer = VMWriter(output_path)
         self._symbol_table = SymbolTable()
@@ -265,19 +270,19 @@ class CompilationEngine:
     @_set_current_grammar_element(Constants.EXPRESSION)
     def _compile_expression(self) -> None:
         self._compile_term()
-        while self._tokenizer.symbol in ['+', '-', '*', '/', '&', '|', '<', '>', '=']: #TODO use this list
-            symbol = self._tokenizer.symbol
-            self._take_symbol(self._tokenizer.symbol)
+        while self._tokenizer.symbol in BINARY_OPERATORS:
+            symbol = self._take_symbol(self._tokenizer.symbol)
             self._compile_term()
             self._vm_writer.write_arithmetic(symbol)
 
     @_set_current_grammar_element(Constants.TERM)
     def _compile_term(self) -> None:
-        if self._tokenizer.token_type == Constants.INTVAL:
+        token_type = self._tokenizer.token_type_code
+        if token_type == INTVAL:
            _int =  self._take_intval()
            self._vm_writer.write_push(Constants.CONSTANT, int(_int))
 
-        elif self._tokenizer.token_type == Constants.STRINGVAL:
+        elif token_type == STRINGVAL:
             string = self._take_strval()
             self._vm_writer.write_push(Constants.CONSTANT, len(string))
             self._vm_writer.write_call('String.new', 1)
@@ -286,7 +291,7 @@ class CompilationEngine:
                 self._vm_writer.write_push(Constants.CONSTANT, ord(char))
                 self._vm_writer.write_call('String.appendChar', 2)
 
-        elif self._tokenizer.token_type == Constants.KEYWORD:
+        elif token_type == KEYWORD:
             keyword = self._take_keyword([Constants.TRUE, Constants.FALSE, Constants.NULL, Constants.THIS])
             if keyword == Constants.TRUE:
                 self._vm_writer.write_push(Constants.CONSTANT, 0)
@@ -295,8 +300,8 @@ class CompilationEngine:
                 self._vm_writer.write_push(Constants.CONSTANT, 0)
             else:
                 self._vm_writer.write_push(Constants.POINTER, 0)
-        elif self._tokenizer.token_type == Constants.SYMBOL:
-            if self._tokenizer.symbol in ['-', '~']:
+        elif token_type == SYMBOL:
+            if self._tokenizer.symbol in UNARY_OPERATORS:
                 symbol = self._tokenizer.symbol
                 symbol = '--' if symbol == '-' else symbol
                 self._take_symbol(self._tokenizer.symbol)
@@ -307,13 +312,16 @@ class CompilationEngine:
                 self._compile_expression()
                 self._take_symbol(')')
             else:
-                raise CompilationError(f'Term only accepts (, ~ and - {Constants.SYMBOL}s, given: '
-                                       f'{self._tokenizer.symbol}')
-        elif self._tokenizer.token_type == Constants.IDENTIFIER:
-            name = self._take_identifier()
-            if self._tokenizer.symbol in ['(', '.']:
-                self._compile_subroutine_call(name)
-            elif self._tokenizer.symbol == '[':
+                raise self._compilation_error(
+                    f'Term only accepts (, ~ and - {Constants.SYMBOL}s, given: '
+                    f'{self._tokenizer.symbol}')
+        elif token_type == IDENTIFIER:
+            # the symbol after the identifier tells a call, an array access and a variable apart
+            _, next_symbol = self._tokenizer.peek()
+            if next_symbol in ['(', '.']:
+                self._compile_subroutine_call()
+            elif next_symbol == '[':
+                name = self._take_identifier()
                 self._write_var('push', name)
                 self._take_symbol('[')
                 self._compile_expression()
@@ -322,7 +330,7 @@ class CompilationEngine:
                 self._vm_writer.write_pop(Constants.POINTER, 1)
                 self._vm_writer.write_push(Constants.THAT, 0)
             else:
-                self._write_var('push', name)
+                self._write_var('push', self._take_identifier())
 
     @_set_current_grammar_element(Constants.SUBROUTINECALL)
     def _compile_subroutine_call(self, name: str = None) -> None:
@@ -388,70 +396,78 @@ class CompilationEngine:
         if extra_keywords is not None:
             keywords.extend(extra_keywords)
 
-        if self._tokenizer.token_type == Constants.KEYWORD:
+        if self._tokenizer.token_type_code == KEYWORD:
             if self._tokenizer.keyword not in keywords:
-                raise CompilationError(
+                raise self._compilation_error(
                     f'{self._current_grammar_element} type can only be {", ".join(keywords)} keywords, given keyword: '
                     f'{self._tokenizer.keyword}')
             return self._take_keyword(keywords)
-        elif self._tokenizer.token_type == Constants.IDENTIFIER:
+        elif self._tokenizer.token_type_code == IDENTIFIER:
             return self._take_identifier()
         else:
-            raise CompilationError(
+            raise self._compilation_error(
                 f'{self._current_grammar_element} type must be {Constants.IDENTIFIER} or {Constants.KEYWORD}, given: '
                 f'{self._tokenizer.token_type}')
 
 
     def _take_symbol(self, symbol: str) -> str:
-        if self._tokenizer.token_type != Constants.SYMBOL or self._tokenizer.symbol != symbol:
-            raise CompilationError(f'{self._current_grammar_element} expected the {Constants.SYMBOL}: {symbol}, given: '
-                                   f'{self._tokenizer.token_type} {self._tokenizer.token}')
-        symbol = self._tokenizer.symbol
+        if self._tokenizer.token_type_code != SYMBOL or self._tokenizer.token != symbol:
+            raise self._compilation_error(
+                f'{self._current_grammar_element} expected the {Constants.SYMBOL}: {symbol}, given: '
+                f'{self._tokenizer.token_type} {self._tokenizer.token}')
         self._tokenizer.advance()
         return symbol
 
     def _take_keyword(self, accepted_keywords: List) -> str:
-        if self._tokenizer.token_type != Constants.KEYWORD:
-            raise CompilationError(f'{self._current_grammar_element} expected a {Constants.KEYWORD}, given token type '
-                                   f'{self._tokenizer.token_type}')
+        if self._tokenizer.token_type_code != KEYWORD:
+            raise self._compilation_error(
+                f'{self._current_grammar_element} expected a {Constants.KEYWORD}, given token type '
+                f'{self._tokenizer.token_type}')
 
-        if self._tokenizer.keyword not in accepted_keywords:
-            raise CompilationError(f'{self._current_grammar_element} keyword should be {", ".join(accepted_keywords)}, '
-                                   f'given: {self._tokenizer.keyword}')
+        keyword = self._tokenizer.token
+        if keyword not in accepted_keywords:
+            raise self._compilation_error(
+                f'{self._current_grammar_element} keyword should be {", ".join(accepted_keywords)}, '
+                f'given: {keyword}')
 
-        keyword = self._tokenizer.keyword
         self._tokenizer.advance()
 
         return keyword
 
     def _take_identifier(self) -> str:
-        if self._tokenizer.token_type != Constants.IDENTIFIER:
-            raise CompilationError(f'{self._current_grammar_element} expected an identifier, given: '
-                                   f'{self._tokenizer.token_type} {self._tokenizer.token}')
-        identifier = self._tokenizer.identifier
+        if self._tokenizer.token_type_code != IDENTIFIER:
+            raise self._compilation_error(
+                f'{self._current_grammar_element} expected an identifier, given: '
+                f'{self._tokenizer.token_type} {self._tokenizer.token}')
+        identifier = self._tokenizer.token
         self._tokenizer.advance()
 
         return identifier
 
     def _take_intval(self) -> str:
-        if self._tokenizer.token_type != Constants.INTVAL:
-            raise CompilationError(f'{self._current_grammar_element} expected an intVal, given: '
-                                   f'{self._tokenizer.token_type}')
-        int_val = self._tokenizer.int_val
+        if self._tokenizer.token_type_code != INTVAL:
+            raise self._compilation_error(
+                f'{self._current_grammar_element} expected an intVal, given: '
+                f'{self._tokenizer.token_type}')
+        int_val = self._tokenizer.token
         self._tokenizer.advance()
 
         return int_val
 
     def _take_strval(self) -> str:
-        if self._tokenizer.token_type != Constants.STRINGVAL:
-            raise CompilationError(f'{self._current_grammar_element} expected a strVal, given: '
-                                   f'{self._tokenizer.token_type}')
-        string_val = self._tokenizer.string_val
+        if self._tokenizer.token_type_code != STRINGVAL:
+            raise self._compilation_error(
+                f'{self._current_grammar_element} expected a strVal, given: '
+                f'{self._tokenizer.token_type}')
+        string_val = self._tokenizer.token
 
         self._tokenizer.advance()
 
         return string_val
 
+    def _compilation_error(self, message: str) -> CompilationError:
+        return CompilationError(f'{self._input_path}, {self._tokenizer.location}: {message}')
+
     def _write_var(self, operation: str, name: str) -> None:
         index = self._symbol_table.index_of(name)
         kind = self._symbol_table.kind_of(name)
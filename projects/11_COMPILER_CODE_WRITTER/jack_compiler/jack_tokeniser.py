@@ -1,143 +1,296 @@
+import mmap
+import os
 import re
-from typing import Generator, Optional, Union
+import sys
+
+from array import array
+from typing import List, Optional, Tuple, Union
 
 from jack_compiler.constants import Constants
 
 
-class JackTokenizer:
+# token type codes held by a TokenBuffer, TOKEN_TYPES maps them to their Constants name
+KEYWORD = 0
+SYMBOL = 1
+IDENTIFIER = 2
+INTVAL = 3
+STRINGVAL = 4
 
-    KEYWORDS = ("class", "constructor", "function", "method", "field", "static", "var", "int", "char", "boolean",
-                "void", "true", "false", "null", "this", "let", "do", "if", "else", "while", "return")
-    SYMBOLS = ("{", "}", "(", ")", "[", "]", ".", ",", ";", "+", "-", "*", "/", "&", "|", "<", ">", "=", "~")
-    SPACE = ("\n", "\t", " ")
+TOKEN_TYPES = (Constants.KEYWORD, Constants.SYMBOL, Constants.IDENTIFIER, Constants.INTVAL, Constants.STRINGVAL)
 
-    def __init__(self, path: str) -> None:
 
-        self._token = None
-        self._token_type = None
-        self.input_char_stream = self._generate_input_char_stream(path)
-        self._current_char = None
-        self._has_more_tokens = True
+def _character_types() -> Tuple[Optional[int], ...]:
+    '''
+    The type code of the tokens starting with each ASCII character, indexed by character code, None if no token does.
+    Words are IDENTIFIER, tokenise looks up the keywords among them.
+    '''
+    character_types: List[Optional[int]] = [None] * 128
+    for characters, token_type in (('{}()[].,;+-*/&|<>=~', SYMBOL),
+                                   ('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_', IDENTIFIER),
+                                   ('0123456789', INTVAL),
+                                   ('"', STRINGVAL)):
+        for character in characters:
+            character_types[ord(character)] = token_type
+    return tuple(character_types)
+
+
+CHARACTER_TYPES = _character_types()
+
+
+class TokenBuffer:
+    '''
+    The tokens of a source as parallel arrays indexed by token: types holds the type code of each, values the token,
+    an int for integer constants and an interned str otherwise, and lines and columns where it starts, counted from 1.
+    '''
+
+    __slots__ = ('types', 'values', 'lines', 'columns')
+
+    def __init__(self) -> None:
+        self.types = array('B')
+        self.values: List[Union[str, int]] = []
+        self.lines = array('I')
+        self.columns = array('I')
+
+    def __len__(self) -> int:
+        return len(self.values)
 
-        self._iterate_current_char()
+    def location(self, index: int) -> str:
+        return f'line {self.lines[index]}, column {self.columns[index]}'
 
-        self.advance()
+
+class JackTokenizer:
+
+    KEYWORDS = frozenset(("class", "constructor", "function", "method", "field", "static", "var", "int", "char",
+                          "boolean", "void", "true", "false", "null", "this", "let", "do", "if", "else", "while",
+                          "return"))
+    SYMBOLS = frozenset(("{", "}", "(", ")", "[", "]", ".", ",", ";", "+", "-", "*", "/", "&", "|", "<", ">", "=",
+                         "~"))
+    SPACE = frozenset(("\n", "\t", " "))
+
+    # a token after the whitespace and comments in skipped, its first character gives its type through CHARACTER_TYPES.
+    # A comment left open and a character starting no token are matched by error, and the end of the source by neither.
+    # As one of the three always matches where skipped ends, skipped is never backtracked into
+    TOKEN_PATTERN = re.compile(r'''
+        (?P<skipped>(?:\s+|//[^\n]*|/\*[^*]*\*+(?:[^/*][^*]*\*+)*/)*)
+        (?:
+            (?P<token>[{}()\[\].,;+\-*&|<>=~]|/(?!\*)|[A-Za-z_]\w*|\d+|"[^"\n]*")
+            |(?P<error>/\*|\S)
+            |\Z
+        )
+    ''', re.VERBOSE | re.ASCII)
+    # TOKEN_PATTERN over the bytes of a source, for tokenise_buffer
+    TOKEN_BYTES_PATTERN = re.compile(TOKEN_PATTERN.pattern.encode(), re.VERBOSE)
+    # size in bytes from which a source is memory mapped rather than read
+    MEMORY_MAP_SIZE = 2 ** 20
+
+    def __init__(self, path: str, memory_map: Optional[bool] = None) -> None:
+        '''
+        memory_map tokenizes the source in place with tokenise_buffer rather than reading it, by default sources of
+        MEMORY_MAP_SIZE bytes or more are.
+        '''
+        if memory_map is None:
+            memory_map = os.path.getsize(path) >= self.MEMORY_MAP_SIZE
+        self._tokens = self._tokenise_mapped(path) if memory_map else self.tokenise(self._read_source(path))
+        self._types = self._tokens.types
+        self._values = self._tokens.values
+        self._index = 0
+        self._last_index = len(self._tokens) - 1
+        self._has_more_tokens = self._last_index >= 0
 
     @property
     def has_more_tokens(self) -> bool:
         return self._has_more_tokens
 
+    @property
+    def tokens(self) -> TokenBuffer:
+        return self._tokens
+
+    @property
+    def index(self) -> int:
+        return self._index
+
     @property
     def token(self) -> Union[Optional[str], Optional[int]]:
-        return self._token
+        if self._last_index < 0:
+            return None
+        return self._values[self._index]
 
     @property
     def token_type(self) -> Optional[str]:
-        return self._token_type
+        if self._last_index < 0:
+            return None
+        return TOKEN_TYPES[self._types[self._index]]
 
     @property
-    def keyword(self) -> Optional[str]:
-        if not self.token_type == Constants.KEYWORD:
+    def token_type_code(self) -> Optional[int]:
+        '''
+        The type of the current token as one of the codes KEYWORD to STRINGVAL, cheaper to compare than token_type.
+        '''
+        if self._last_index < 0:
             return None
-        return self._token
+        return self._types[self._index]
+
+    @property
+    def location(self) -> str:
+        if self._last_index < 0:
+            return 'line 1, column 1'
+        return self._tokens.location(self._index)
+
+    @property
+    def keyword(self) -> Optional[str]:
+        return self._value_if(KEYWORD)
 
     @property
     def symbol(self) -> Optional[str]:
-        if not self.token_type == Constants.SYMBOL:
-            return None
-        return self._token
+        return self._value_if(SYMBOL)
 
     @property
     def identifier(self) -> Optional[str]:
-        if not self.token_type == Constants.IDENTIFIER:
-            return None
-        return self._token
+        return self._value_if(IDENTIFIER)
 
     @property
-    def int_val(self) -> Optional[str]:
-        if not self.token_type == Constants.INTVAL:
-            return None
-        return self._token
+    def int_val(self) -> Optional[int]:
+        return self._value_if(INTVAL)
 
     @property
     def string_val(self) -> Optional[str]:
-        if not self.token_type == Constants.STRINGVAL:
+        return self._value_if(STRINGVAL)
+
+    def _value_if(self, token_type: int) -> Union[Optional[str], Optional[int]]:
+        if self._last_index < 0 or self._types[self._index] != token_type:
             return None
-        return self._token
+        return self._values[self._index]
 
     @staticmethod
-    def _generate_input_char_stream(path: str) -> Generator[str, None, None]:
+    def _read_source(path: str) -> str:
         with open(path, 'r') as f:
-            lines = f.readlines()
-            removed_comments_lines = []
-            for line in lines:
-                code_part = line.split('//')[0]
-                removed_comments_lines.append(code_part)
-
-            removed_comments_code = ' '.join(removed_comments_lines)
-            multi_line_comment_regex = r'(/\*\*)(.|\n)*?(\*/)'
-            removed_multi_line_comment_code = re.sub(multi_line_comment_regex, ' ', removed_comments_code)
-
-        for char in removed_multi_line_comment_code:
-            yield char
-
-    def _iterate_current_char(self):
-        if self.has_more_tokens:
-            self._current_char = next(self.input_char_stream, None)
-            if self._current_char is None:
-                self._has_more_tokens = False
-
-    def advance(self) -> None:
-        if not self.has_more_tokens:
-            return
-
-        while self._current_char and self._current_char.isspace():
-            self._iterate_current_char()
-
-        if self._current_char == '"':
-            string_list = []
-            self._iterate_current_char()
-            while self._current_char != '"':
-                string_list.append(self._current_char)
-                self._iterate_current_char()
-            string = ''.join(string_list)
-
-            self._token = string
-            self._token_type = Constants.STRINGVAL
-
-            self._iterate_current_char()
-
-        elif self._current_char in self.SYMBOLS:
-            self._token = self._current_char
-            self._token_type = Constants.SYMBOL
-
-            self._iterate_current_char()
-
-        elif self._current_char and self._current_char.isdigit():
-            integer_list = []
-            while self._current_char and self._current_char.isdigit():
-                integer_list.append(self._current_char)
-                self._iterate_current_char()
-            integer = int(''.join(integer_list))
-            self._token = integer
-            self._token_type = Constants.INTVAL
-
-        elif self._current_char and self._current_char.isalpha() or self._current_char == '_':
-            identifier_or_keyword_list = []
-            while self._current_char and self._current_char.isalpha() or self._current_char == '_':
-                identifier_or_keyword_list.append(self._current_char)
-                self._iterate_current_char()
-
-            identifier_or_keyword = ''.join(identifier_or_keyword_list)
-            self._token = identifier_or_keyword
-
-            if identifier_or_keyword in self.KEYWORDS:
-                self._token_type = Constants.KEYWORD
+            return f.read()
+
+    @classmethod
+    def _tokenise_mapped(cls, path: str) -> TokenBuffer:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return TokenBuffer()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                return cls.tokenise_buffer(buffer)
+
+    @classmethod
+    def tokenise(cls, source: str) -> TokenBuffer:
+        '''
+        Every token in source, scanned in one pass of TOKEN_PATTERN that also skips comments, so the source is read once
+        in linear time.
+        '''
+        tokens = TokenBuffer()
+        add_type, add_value, add_line, add_column = (tokens.types.append, tokens.values.append, tokens.lines.append,
+                                                     tokens.columns.append)
+        keywords = cls.KEYWORDS
+        character_types = CHARACTER_TYPES
+        intern = sys.intern
+        # offset is where skipped starts, only skipped whitespace and comments can span lines
+        offset, line, line_start = 0, 1, 0
+        for skipped, token, error in cls.TOKEN_PATTERN.findall(source):
+            if '\n' in skipped:
+                line += skipped.count('\n')
+                line_start = offset + skipped.rfind('\n') + 1
+            offset += len(skipped)
+            column = offset - line_start + 1
+
+            if token:
+                token_type = character_types[ord(token[0])]
+                if token_type == SYMBOL:
+                    add_value(token)
+                elif token_type == IDENTIFIER:
+                    if token in keywords:
+                        token_type = KEYWORD
+                    add_value(intern(token))
+                elif token_type == INTVAL:
+                    add_value(int(token))
+                else:
+                    add_value(intern(token[1:-1]))
+                add_type(token_type)
+                offset += len(token)
+            elif error == '/*':
+                raise Exception(f'line {line}, column {column}: Unterminated comment')
+            elif error:
+                raise Exception(f'line {line}, column {column}: Unable to tokenize {error}')
             else:
-                self._token_type = Constants.IDENTIFIER
-
-        elif self._current_char is None:
-            return
+                break
+            add_line(line)
+            add_column(column)
+        return tokens
+
+    @classmethod
+    def tokenise_buffer(cls, buffer: Union[bytes, mmap.mmap]) -> TokenBuffer:
+        '''
+        Every token in buffer, a UTF-8 source, scanned in place by TOKEN_BYTES_PATTERN one match at a time. Only the
+        tokens are copied out of it, so memory beyond the TokenBuffer does not grow with the source. Columns count bytes.
+        '''
+        tokens = TokenBuffer()
+        add_type, add_value, add_line, add_column = (tokens.types.append, tokens.values.append, tokens.lines.append,
+                                                     tokens.columns.append)
+        keywords = cls.KEYWORDS
+        character_types = CHARACTER_TYPES
+        intern = sys.intern
+        find = buffer.find
+        line, line_start = 1, 0
+        # groups 1 to 3 are skipped, token and error, the last of them to match tells what was matched
+        for match in cls.TOKEN_BYTES_PATTERN.finditer(buffer):
+            skipped_start, start = match.span(1)
+            newline = find(b'\n', skipped_start, start)
+            while newline >= 0:
+                line += 1
+                line_start = newline + 1
+                newline = find(b'\n', line_start, start)
+            column = start - line_start + 1
+
+            matched = match.lastindex
+            if matched == 2:
+                token = match.group(2)
+                token_type = character_types[token[0]]
+                if token_type == SYMBOL:
+                    add_value(token.decode('ascii'))
+                elif token_type == IDENTIFIER:
+                    word = intern(token.decode('ascii'))
+                    if word in keywords:
+                        token_type = KEYWORD
+                    add_value(word)
+                elif token_type == INTVAL:
+                    add_value(int(token))
+                else:
+                    add_value(intern(token[1:-1].decode('utf-8')))
+                add_type(token_type)
+            elif matched == 3:
+                if match.group(3) == b'/*':
+                    raise Exception(f'line {line}, column {column}: Unterminated comment')
+                # the error matched the first byte of its character, which takes up to 4
+                error = buffer[start:start + 4].decode('utf-8', 'replace')[0]
+                raise Exception(f'line {line}, column {column}: Unable to tokenize {error}')
+            else:
+                break
+            add_line(line)
+            add_column(column)
+        return tokens
 
+    def advance(self) -> None:
+        if self._index < self._last_index:
+            self._index += 1
         else:
-            raise Exception(f'Unable to tokenize {self._current_char}')
+            self._has_more_tokens = False
+
+    def peek(self, offset: int = 1) -> Tuple[Optional[str], Union[Optional[str], Optional[int]]]:
+        '''
+        The type and value of the token offset tokens after the current one, or Nones past the end, without advancing.
+        '''
+        index = self._index + offset
+        if not 0 <= index <= self._last_index:
+            return None, None
+        return TOKEN_TYPES[self._types[index]], self._values[index]
+
+    def seek(self, index: int) -> None:
+        '''
+        Makes the token at index, as given by the index property, the current token, for backtracking.
+        '''
+        if not 0 <= index < len(self._tokens):
+            raise IndexError(f'no token {index}, there are {len(self._tokens)}')
+        self._index = index
+        self._has_more_tokens = True